@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Measures how long TapeyTape.on_stroked takes per stroke by driving it
+# through a stand-in engine built from Plover's own translator, formatter,
+# and dictionary classes, loaded with large synthetic dictionaries.
+#
+#   python bench.py                          # run all scenarios
+#   python bench.py -s prose -n 5000         # run one scenario
+#   python bench.py -o new.json -c old.json  # save results and compare
+
+import argparse
+import json
+import pathlib
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from plover.registry import registry
+registry.update()
+
+import plover.system
+plover.system.setup('English Stenotype')
+
+from plover.formatting import Formatter
+from plover.steno import Stroke
+from plover.steno_dictionary import StenoDictionary, StenoDictionaryCollection
+from plover.translation import Translator
+
+import plover_tapey_tape
+
+LEFT   = ['S-', 'T-', 'K-', 'P-', 'W-', 'H-', 'R-']
+VOWELS = ['A-', 'O-', '-E', '-U']
+RIGHT  = ['-F', '-R', '-P', '-B', '-L', '-G', '-T', '-S', '-D', '-Z']
+
+LETTERS = {
+    'a': 'A*', 'b': 'PW*', 'c': 'KR*', 'd': 'TK*', 'e': '*E', 'f': 'TP*', 'g': 'TKPW*',
+    'h': 'H*', 'i': '*EU', 'j': 'SKWR*', 'k': 'K*', 'l': 'HR*', 'm': 'PH*', 'n': 'TPH*',
+    'o': 'O*', 'p': 'P*', 'q': 'KW*', 'r': 'R*', 's': 'S*', 't': 'T*', 'u': '*U',
+    'v': 'SR*', 'w': 'W*', 'x': 'KP*', 'y': 'KWR*', 'z': 'STKPW*',
+}
+
+FINGERSPELLED = ['kvetch', 'schlep', 'quixotic', 'zephyr', 'jackknife', 'abc', 'xylophone', 'fjord']
+
+SUFFIXES = {'-G': '{^ing}', '-D': '{^ed}', '-S': '{^s}', '-LG': '{^ly}', '-PLT': '{^ment}', '-BL': '{^able}'}
+
+class NullOutput:
+    def send_backspaces(self, b):
+        pass
+
+    def send_string(self, s):
+        pass
+
+    def send_key_combination(self, c):
+        pass
+
+    def send_engine_command(self, c):
+        pass
+
+class MockEngine:
+    # Just enough of plover.engine.StenoEngine for TapeyTape
+
+    def __init__(self, dictionaries):
+        self.output = True
+        self.dictionaries = StenoDictionaryCollection(dictionaries)
+        self.translator = Translator()
+        self.translator.set_dictionary(self.dictionaries)
+        self.translator.set_min_undo_length(100)
+        self.formatter = Formatter()
+        self.formatter.set_output(NullOutput())
+        self.translator.add_listener(self.formatter.format)
+        self.hooks = {}
+
+    @property
+    def translator_state(self):
+        return self.translator.get_state()
+
+    def hook_connect(self, hook, callback):
+        self.hooks.setdefault(hook, []).append(callback)
+
+    def hook_disconnect(self, hook, callback):
+        self.hooks[hook].remove(callback)
+
+    def translate(self, stroke):
+        self.translator.translate(stroke)
+
+    def trigger(self, hook, *args):
+        for callback in self.hooks.get(hook, []):
+            callback(*args)
+
+def random_stroke(rng):
+    keys = rng.sample(LEFT, rng.randint(0, 3)) + rng.sample(VOWELS, rng.randint(1, 2)) + rng.sample(RIGHT, rng.randint(0, 3))
+    return Stroke(keys).rtfcre
+
+def make_dictionaries(entries, count, rng):
+    # Returns the dictionaries (highest priority first) and the words in
+    # them. Some words get both a long and a short outline so that
+    # suggestions have something to find.
+    words = [f'w{i}' for i in range(entries)]
+    outlines = set()
+    dictionaries = []
+    per_dictionary = entries // count
+    for n in range(count):
+        dictionary = StenoDictionary()
+        dictionary.path = f'/bench/dictionary{n}.json'
+        for word in words[n * per_dictionary:(n + 1) * per_dictionary]:
+            while True:
+                outline = tuple(random_stroke(rng) for _ in range(rng.choice((1, 1, 2, 2, 3))))
+                if outline not in outlines:
+                    break
+            outlines.add(outline)
+            dictionary[outline] = word
+        dictionaries.append(dictionary)
+    extra = StenoDictionary()
+    extra.path = '/bench/extra.json'
+    for letter, steno in LETTERS.items():
+        extra[(steno,)] = '{>}{&' + letter + '}'
+    for steno, suffix in SUFFIXES.items():
+        extra[(steno,)] = suffix
+    extra[('TP-PL',)] = '{.}'
+    for word in FINGERSPELLED[::2]:
+        # Shorter outlines for some fingerspelled words
+        extra[(random_stroke(rng),)] = word
+    dictionaries.append(extra)
+    return dictionaries, words
+
+def scenario_prose(rng, dictionaries, words, n):
+    by_word = {}
+    for dictionary in dictionaries[:-1]:
+        for outline, word in dictionary.items():
+            by_word[word] = outline
+    common = rng.sample(words, 500)
+    strokes = []
+    while len(strokes) < n:
+        word = rng.choice(common) if rng.random() < 0.8 else rng.choice(words)
+        strokes.extend(by_word[word])
+        if rng.random() < 0.05:
+            strokes.append('TP-PL')
+    return strokes[:n]
+
+def scenario_fingerspelling(rng, dictionaries, words, n):
+    strokes = []
+    while len(strokes) < n:
+        word = rng.choice(FINGERSPELLED)
+        if rng.random() < 0.3:
+            word *= rng.randint(2, 6)
+        for letter in word:
+            strokes.append(LETTERS[letter])
+        strokes.extend(next(iter(dictionaries[0].items()))[0])
+    return strokes[:n]
+
+def scenario_undo(rng, dictionaries, words, n):
+    prose = scenario_prose(rng, dictionaries, words, n)
+    strokes = []
+    for stroke in prose:
+        strokes.append(stroke)
+        if rng.random() < 0.2:
+            strokes.extend(['*'] * rng.randint(1, 15))
+    return strokes[:n]
+
+def scenario_suffixes(rng, dictionaries, words, n):
+    prose = scenario_prose(rng, dictionaries, words, n)
+    strokes = []
+    for stroke in prose:
+        strokes.append(stroke)
+        strokes.extend(rng.choices(list(SUFFIXES), k=rng.randint(0, 6)))
+    return strokes[:n]
+
+SCENARIOS = {
+    'prose': scenario_prose,
+    'fingerspelling': scenario_fingerspelling,
+    'undo': scenario_undo,
+    'suffixes': scenario_suffixes,
+}
+
+def run(strokes, dictionaries, config, measure_memory):
+    # Returns the time (in seconds) or peak allocation (in bytes) of each
+    # call to on_stroked.
+    with tempfile.TemporaryDirectory() as directory:
+        plover_tapey_tape.CONFIG_DIR = pathlib.Path(directory)
+        (plover_tapey_tape.CONFIG_DIR / 'tapey_tape.json').write_text(json.dumps(config), encoding='utf-8')
+        engine = MockEngine(dictionaries)
+        tapey_tape = plover_tapey_tape.TapeyTape(engine)
+        tapey_tape.start()
+        samples = []
+        if measure_memory:
+            tracemalloc.start()
+        for steno in strokes:
+            stroke = Stroke(steno)
+            engine.translate(stroke)
+            if measure_memory:
+                tracemalloc.reset_peak()
+                before, _ = tracemalloc.get_traced_memory()
+                tapey_tape.on_stroked(stroke)
+                _, peak = tracemalloc.get_traced_memory()
+                samples.append(peak - before)
+            else:
+                start = time.perf_counter()
+                tapey_tape.on_stroked(stroke)
+                samples.append(time.perf_counter() - start)
+        if measure_memory:
+            tracemalloc.stop()
+        tapey_tape.stop()
+    return samples
+
+def percentile(sorted_samples, fraction):
+    return sorted_samples[min(int(len(sorted_samples) * fraction), len(sorted_samples) - 1)]
+
+def summarize(times, allocations):
+    times = sorted(times)
+    return {
+        'strokes': len(times),
+        'mean_us': statistics.fmean(times) * 1e6,
+        'p50_us': percentile(times, 0.50) * 1e6,
+        'p99_us': percentile(times, 0.99) * 1e6,
+        'max_us': times[-1] * 1e6,
+        'mean_alloc_bytes': statistics.fmean(allocations),
+        'max_alloc_bytes': max(allocations),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Tapey Tape per-stroke latency.')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (default: all)')
+    parser.add_argument('-n', '--strokes', type=int, default=2000, help='strokes per scenario')
+    parser.add_argument('-e', '--entries', type=int, default=150000, help='total dictionary entries')
+    parser.add_argument('-d', '--dictionaries', type=int, default=15, help='number of stacked dictionaries')
+    parser.add_argument('-f', '--line-format', default='%b |%S| %D  %s', help='line_format to benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('-c', '--compare', help='compare with results previously written with -o')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    dictionaries, words = make_dictionaries(args.entries, args.dictionaries, rng)
+    config = {'line_format': args.line_format}
+
+    results = {
+        'config': {'strokes': args.strokes,
+                   'entries': args.entries,
+                   'dictionaries': args.dictionaries,
+                   'line_format': args.line_format,
+                   'seed': args.seed,
+                   'python': sys.version.split()[0]},
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        strokes = SCENARIOS[name](random.Random(args.seed), dictionaries, words, args.strokes)
+        times = run(strokes, dictionaries, config, measure_memory=False)
+        allocations = run(strokes, dictionaries, config, measure_memory=True)
+        results['scenarios'][name] = summarize(times, allocations)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['scenarios']
+
+    columns = ('p50_us', 'p99_us', 'max_us', 'mean_alloc_bytes')
+    print(f'{"scenario":16}' + ''.join(f'{column:>18}' for column in columns))
+    for name, summary in results['scenarios'].items():
+        row = f'{name:16}'
+        for column in columns:
+            cell = f'{summary[column]:.1f}'
+            if baseline is not None and name in baseline and baseline[name][column]:
+                cell += f' ({summary[column] / baseline[name][column]:.2f}x)'
+            row += f'{cell:>18}'
+        print(row)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
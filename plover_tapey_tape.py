@@ -6,17 +6,53 @@
 #    \ )      )  [ T     A  EU  P  ] tape
 #     `-------'
 
+import argparse
+import array
+import bisect
 import collections
+import cProfile
+import concurrent.futures
 import datetime
+import glob
+import gzip
+import io
 import itertools
 import json
+import math
+import os
 import pathlib
+import pstats
+import queue
 import re
+import selectors
+import shutil
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
 
 import plover
+import plover.system
+from plover import log
 
 CONFIG_DIR = pathlib.Path(plover.oslayer.config.CONFIG_DIR)
 
+DICTIONARY_CACHE_SIZE = 4096
+
+WRITER_TIMEOUT = 1.0 # seconds to wait for a stuck writer thread when stopping
+
+BACKFILL_QUEUE_SIZE = 100      # suggestion jobs waiting for a pause; more are dropped
+BACKFILL_ITEMS = ('t', 'S', 'r') # items kept on a line of backfilled suggestions
+
+HESITATION_BUCKETS = 32
+HESITATION_BASE    = 0.025 # seconds
+HESITATION_GROWTH  = 1.4
+HESITATION_PAUSE   = 10.0  # longer hesitations are breaks, not hesitations
+HESITATION_MIN_COUNT = 5   # strokes needed to count among the slowest outlines
+HESITATION_SLOWEST   = 100 # slowest outlines kept even when evicted from the table
+
 SHOW_WHITESPACE = str.maketrans({'\n': '\\n', '\r': '\\r', '\t': '\\t'})
 
 def make_absolute(filename):
@@ -25,6 +61,14 @@ def make_absolute(filename):
         return CONFIG_DIR / path
     return path
 
+def write_atomically(path, data):
+    # Readers never see a half-written file
+    temporary = path.with_name(path.name + '.tmp')
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with temporary.open(mode, **({} if mode == 'wb' else {'encoding': 'utf-8'})) as f:
+        f.write(data)
+    os.replace(temporary, path)
+
 def has_no_text(translation):
     return all(not action.text for action in translation.formatting)
 
@@ -108,14 +152,179 @@ def suggestion_keys(translations):
                     and definition_starts_with_lowercase(translations[0])):
                 output = output[0].lower() + output[1:]
             last_action = action
-    if is_prefix(translations[0]) and is_suffix(translations[-1]):
+    return affixed_keys(output, translations[0], translations[-1])
+
+def affixed_keys(output, first, last):
+    if is_prefix(first) and is_suffix(last):
         return [f'{{^{output}^}}', f'{{^}}{output}{{^}}']
-    if is_prefix(translations[0]):
+    if is_prefix(first):
         return [f'{{^{output}}}', f'{{^}}{output}']
-    if is_suffix(translations[-1]):
+    if is_suffix(last):
         return [f'{{{output}^}}', f'{output}{{^}}']
     return [output]
 
+# To avoid replaying every action of every tail from scratch, the effect of
+# a run of actions (other than the very first action of a tail, which is
+# special) on whatever output precedes it is summarized as a tuple
+#   (deleted, space, text, needed)
+# meaning: delete `deleted` characters from the end of the preceding output;
+# then, if `space` is not None and what's left is non-empty, append `space`;
+# then append `text`. `needed` is the minimum length the preceding output
+# must have for the run not to over-backspace a retroactive command.
+# Effects compose, so a tail's effect can be extended to the left one
+# translation at a time.
+
+NO_EFFECT = (0, None, '', 0)
+
+def compose_effects(first, second):
+    first_deleted, first_space, first_text, first_needed = first
+    second_deleted, second_space, second_text, second_needed = second
+    first_space_width = 0 if first_space is None else len(first_space)
+
+    missing = second_needed - len(first_text)
+    if missing > 0:
+        # What precedes the second run has to come partly from before the first
+        if first_space is None:
+            needed = max(first_needed, first_deleted + missing)
+        else:
+            needed = max(first_needed, first_deleted + max(missing - first_space_width, 1))
+    else:
+        needed = first_needed
+
+    excess = second_deleted - len(first_text)
+    if excess <= 0:
+        deleted = first_deleted
+        space   = first_space
+        text    = first_text[:len(first_text) - second_deleted]
+    elif excess < first_space_width:
+        deleted = first_deleted
+        space   = first_space[:first_space_width - excess]
+        text    = ''
+    else:
+        deleted = first_deleted + excess - first_space_width
+        space   = None
+        text    = ''
+
+    if second_space is not None:
+        if text:
+            text += second_space
+        elif space is not None:
+            # Either both spaces or neither end up in the output
+            space += second_space
+        else:
+            space = second_space
+
+    return deleted, space, text + second_text, needed
+
+def actions_effect(translation, actions):
+    retroactive = is_retroactive(translation)
+    effect = NO_EFFECT
+    for action in actions:
+        replace = len(action.prev_replace)
+        effect = compose_effects(effect, (
+            replace,
+            action.space_char if action.text is not None and not action.prev_attach else None,
+            action.text or '',
+            replace if retroactive else 0,
+        ))
+    return effect
+
+def apply_effect(effect, output):
+    deleted, space, text, needed = effect
+    if len(output) < needed:
+        return None
+    output = output[:max(len(output) - deleted, 0)]
+    if space is not None and output:
+        output += space
+    return output + text
+
+def tail_suggestion_keys(translations):
+    # Equivalent to
+    #   ((sum(len(translation.rtfcre) for translation in tail), suggestion_keys(tail))
+    #    for tail in tails(translations))
+    # but each tail and its output are extended from the previous one
+    # instead of being rebuilt from scratch.
+    if (not translations
+            or has_no_text(translations[-1]) and not is_attach(translations[-1])):
+        return
+    last = translations[-1]
+    tail = collections.deque()
+    strokes = 0
+    all_attach = True
+    rest_effect = NO_EFFECT  # effect of the tail minus its first translation
+    first_effect = NO_EFFECT # effect of the first translation
+
+    def extend(group):
+        nonlocal strokes, all_attach, rest_effect, first_effect
+        tail.extendleft(reversed(group))
+        effect = first_effect
+        for translation in reversed(group[1:]):
+            effect = compose_effects(actions_effect(translation, translation.formatting), effect)
+        first = group[0]
+        rest_effect = compose_effects(effect, rest_effect)
+        strokes += sum(len(translation.rtfcre) for translation in group)
+        all_attach = all_attach and all(map(is_attach, group))
+        head_effect = actions_effect(first, first.formatting[:1])
+        body_effect = actions_effect(first, first.formatting[1:])
+        if all_attach:
+            keys = []
+        elif not first.formatting:
+            # The first action of the tail belongs to a later translation
+            keys = suggestion_keys(tuple(tail))
+        else:
+            output = apply_effect(head_effect, '')
+            if (output
+                    and output[0].isupper()
+                    and definition_starts_with_lowercase(first)):
+                output = output[0].lower() + output[1:]
+            if output is not None:
+                output = apply_effect(compose_effects(body_effect, rest_effect), output)
+            keys = [] if output is None else affixed_keys(output, first, last)
+        first_effect = compose_effects(head_effect, body_effect)
+        return strokes, keys
+
+    fingerspellings = []
+    for translation in reversed(translations):
+        if is_fingerspelling(translation):
+            fingerspellings.append(translation)
+        else:
+            if fingerspellings:
+                yield extend(fingerspellings[::-1])
+                fingerspellings = []
+            yield extend([translation])
+    if fingerspellings:
+        yield extend(fingerspellings[::-1])
+
+def collect_suggestions(tails, lookup, seen_suggestion_keys, suggestions, deadline=None, fewest_strokes=None):
+    # Appends [number of translations, outlines] to suggestions for each of
+    # the numbered tails (from tail_suggestion_keys) that can be written
+    # with fewer strokes. If time.perf_counter() passes the deadline,
+    # returns the number of tails handled so far; otherwise returns None.
+    # fewest_strokes, if given, maps translations to a lower bound on the
+    # number of strokes they take (see OutlineIndex); keys that can't be
+    # written in fewer strokes aren't looked up.
+    handled = 0
+    for i, (total_strokes, keys) in tails:
+        if deadline is not None and time.perf_counter() > deadline:
+            return handled
+        outlines = []
+        for suggestion_key in keys:
+            if suggestion_key not in seen_suggestion_keys:
+                seen_suggestion_keys.add(suggestion_key)
+                if fewest_strokes is not None and fewest_strokes.get(suggestion_key, total_strokes) >= total_strokes:
+                    continue
+                for outline in lookup(suggestion_key):
+                    if len(outline) < total_strokes:
+                        outlines.append(outline)
+        if outlines:
+            suggestions.append([i, list(map('/'.join, sorted(outlines, key=len)))])
+        handled += 1
+    return None
+
+def format_suggestions(suggestions, marker):
+    return ' '.join(('' if i == 1 else str(i)) + marker + ' '.join(outlines)
+                    for i, outlines in suggestions)
+
 def retroformat(translation):
     output = ''
     last_action = None
@@ -140,56 +349,1837 @@ def expand(format_string, items):
         return items.get(letter, '').ljust(width)
     return re.sub(r'%(\d*)(.)', replace, format_string)
 
+def find_dictionary(dictionaries, outline):
+    # The highest-priority dictionary containing the outline
+    for dictionary in dictionaries.dicts:
+        if outline in dictionary:
+            return dictionary
+    return None
+
+def dictionaries_generation(dictionaries):
+    # Changes whenever a dictionary is added, removed, reordered, enabled,
+    # disabled, reloaded, or edited through Plover (which saves it and
+    # thereby updates its timestamp) -- including edits that don't trigger
+    # any engine hook.
+    return tuple((id(dictionary), dictionary.enabled, dictionary.timestamp, len(dictionary))
+                 for dictionary in dictionaries.dicts)
+
+FORMAT_CODE = re.compile(r'%(\d*)(.)')
+
+# Codes whose values are computed for each stroke
+ITEM_CODES = frozenset('tbSrDTds')
+
+def compile_format(format_string):
+    # Turns a format string into a list of (text, letter, width) segments,
+    # where letter is None for literal text. Codes that don't depend on the
+    # stroke (%% and unknown letters) are expanded right away, so
+    #   format_line(compile_format(format_string), items)
+    # is the same as expand(format_string, items).
+    segments = []
+    literal = ''
+    position = 0
+    for matchobj in FORMAT_CODE.finditer(format_string):
+        literal += format_string[position:matchobj.start()]
+        position = matchobj.end()
+        width, letter = matchobj.groups()
+        width = 0 if not width else int(width)
+        if letter in ITEM_CODES:
+            if literal:
+                segments.append((literal, None, 0))
+                literal = ''
+            segments.append(('', letter, width))
+        else:
+            literal += ('%' if letter == '%' else '').ljust(width)
+    literal += format_string[position:]
+    if literal:
+        segments.append((literal, None, 0))
+    return segments
+
+def format_line(segments, items):
+    return ''.join(text if letter is None else items[letter].ljust(width)
+                   for text, letter, width in segments)
+
+# Structured stroke records are dicts with the following keys:
+#   time           milliseconds since the epoch
+#   stroke         raw steno, e.g., "KWRURPB"
+#   keys           list of steno keys, e.g., ["K-", "W-", "R-", "-U", "-R", "-P", "-B"]
+#   hesitation_ms  milliseconds since the previous stroke, or None
+#   undo           whether the stroke is an undo stroke
+#   definition     dictionary definition, or None if untranslated or undo
+#   translation    translated text, or None if undo
+#   corrected      whether the translation replaced earlier ones
+#   dictionary     path of the dictionary the outline is from, or None
+#   suggestions    list of [number of translations, list of outlines]
+#   backfilled     only present (and true) on a record that repeats an
+#                  earlier one, with the same time and stroke, to add the
+#                  suggestions found in the background after it was written
+#
+# A binary record file starts with the magic bytes RECORDS_MAGIC, after
+# which each record is a 4-byte little-endian length
+# followed by that many bytes: time (int64), hesitation_ms (int32, -1 for
+# None), flags (uint8: 1 = undo, 2 = corrected, 4 = backfilled), the
+# strings stroke, keys (space-separated), definition, translation, and
+# dictionary (each a uint32 length, 0xFFFFFFFF for None, followed by
+# UTF-8), and the suggestions (uint32 count, then for each a uint32
+# number of translations, a uint32 outline count, and the outlines as
+# strings).
+
+RECORDS_MAGIC = b'TTRB'
+RECORD_HEADER = struct.Struct('<qiB')
+RECORD_LENGTH = struct.Struct('<I')
+RECORD_SUGGESTION = struct.Struct('<II')
+NO_STRING = 0xFFFFFFFF
+
+def encode_json_record(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+def encode_binary_record(record):
+    parts = [RECORD_HEADER.pack(record['time'],
+                                -1 if record['hesitation_ms'] is None else record['hesitation_ms'],
+                                record['undo'] | record['corrected'] << 1 | record.get('backfilled', False) << 2)]
+    def add_string(string):
+        if string is None:
+            parts.append(RECORD_LENGTH.pack(NO_STRING))
+        else:
+            data = string.encode('utf-8')
+            parts.append(RECORD_LENGTH.pack(len(data)))
+            parts.append(data)
+    add_string(record['stroke'])
+    add_string(' '.join(record['keys']))
+    add_string(record['definition'])
+    add_string(record['translation'])
+    add_string(record['dictionary'])
+    parts.append(RECORD_LENGTH.pack(len(record['suggestions'])))
+    for translations, outlines in record['suggestions']:
+        parts.append(RECORD_SUGGESTION.pack(translations, len(outlines)))
+        for outline in outlines:
+            add_string(outline)
+    payload = b''.join(parts)
+    return RECORD_LENGTH.pack(len(payload)) + payload
+
+def decode_binary_records(data):
+    # Yields the records in a bytes-like object produced by concatenating
+    # the output of encode_binary_record (without RECORDS_MAGIC)
+    view = memoryview(data)
+    position = 0
+    def read_string():
+        nonlocal position
+        (length,) = RECORD_LENGTH.unpack_from(view, position)
+        position += RECORD_LENGTH.size
+        if length == NO_STRING:
+            return None
+        string = str(view[position:position + length], 'utf-8')
+        position += length
+        return string
+    while position < len(view):
+        (length,) = RECORD_LENGTH.unpack_from(view, position)
+        position += RECORD_LENGTH.size
+        end = position + length
+        time_, hesitation, flags = RECORD_HEADER.unpack_from(view, position)
+        position += RECORD_HEADER.size
+        record = {'time': time_, 'hesitation_ms': None if hesitation < 0 else hesitation,
+                  'undo': bool(flags & 1), 'corrected': bool(flags & 2)}
+        if flags & 4:
+            record['backfilled'] = True
+        record['stroke'] = read_string()
+        keys = read_string()
+        record['keys'] = keys.split(' ') if keys else []
+        record['definition'] = read_string()
+        record['translation'] = read_string()
+        record['dictionary'] = read_string()
+        suggestions = []
+        (count,) = RECORD_LENGTH.unpack_from(view, position)
+        position += RECORD_LENGTH.size
+        for _ in range(count):
+            translations, outline_count = RECORD_SUGGESTION.unpack_from(view, position)
+            position += RECORD_SUGGESTION.size
+            suggestions.append([translations, [read_string() for _ in range(outline_count)]])
+        record['suggestions'] = suggestions
+        position = end
+        yield record
+
+def read_records(path):
+    # Reads a file of structured records in either format
+    data = pathlib.Path(path).read_bytes()
+    if data.startswith(RECORDS_MAGIC):
+        return list(decode_binary_records(memoryview(data)[len(RECORDS_MAGIC):]))
+    return [json.loads(line) for line in data.decode('utf-8').splitlines() if line]
+
+class TapeEntry:
+    # A structured stroke record (see above) in compact form
+
+    __slots__ = ('time', 'stroke', 'keys', 'hesitation_ms', 'undo', 'definition',
+                 'translation', 'corrected', 'dictionary', 'suggestions')
+
+    def __init__(self, record):
+        self.time          = record['time']
+        self.stroke        = record['stroke']
+        self.keys          = tuple(record['keys'])
+        self.hesitation_ms = record['hesitation_ms']
+        self.undo          = record['undo']
+        self.definition    = record['definition']
+        self.translation   = record['translation']
+        self.corrected     = record['corrected']
+        self.dictionary    = record['dictionary']
+        self.suggestions   = tuple((translations, tuple(outlines))
+                                   for translations, outlines in record['suggestions'])
+
+class TapeHistory:
+    # The last size entries of the tape, in a ring preallocated at start so
+    # that memory stays flat however long the session. Entries are added by
+    # the engine thread once their line is complete (i.e., after any delay
+    # due to fingerspelling), and can be read from any thread. Reads return
+    # lists of entries, oldest first.
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = [None] * size
+        self.count = 0 # entries added so far, including overwritten ones
+        self.lock = threading.Lock()
+
+    def append(self, record):
+        entry = TapeEntry(record)
+        with self.lock:
+            self.entries[self.count % self.size] = entry
+            self.count += 1
+
+    def update_suggestions(self, time_, stroke, suggestions):
+        # Replaces the suggestions of the entry for the stroke at time_
+        # (in milliseconds since the epoch), if it's still in the history
+        suggestions = tuple((translations, tuple(outlines)) for translations, outlines in suggestions)
+        with self.lock:
+            for entry in self.newest():
+                if entry.time < time_:
+                    break
+                if entry.time == time_ and entry.stroke == stroke:
+                    entry.suggestions = suggestions
+                    break
+
+    def newest(self):
+        # Entries from newest to oldest; to be called with the lock held
+        for index in range(self.count - 1, max(self.count - self.size, 0) - 1, -1):
+            yield self.entries[index % self.size]
+
+    def last(self, n):
+        with self.lock:
+            entries = list(itertools.islice(self.newest(), n))
+        entries.reverse()
+        return entries
+
+    def since(self, timestamp):
+        # Entries from timestamp (in seconds since the epoch, like
+        # time.time()) onwards
+        milliseconds = timestamp * 1000
+        with self.lock:
+            entries = list(itertools.takewhile(lambda entry: entry.time >= milliseconds, self.newest()))
+        entries.reverse()
+        return entries
+
+    def with_suggestions(self, n=None):
+        # The last n (or all) entries that have suggestions
+        with self.lock:
+            entries = list(itertools.islice((entry for entry in self.newest() if entry.suggestions), n))
+        entries.reverse()
+        return entries
+
+# Time indexes are sidecar files mapping times to byte offsets in a tape
+# file, so that a time range can be found without reading everything
+# before it. <tape> and <tape>.<timestamp>.gz are indexed by <tape>.idx
+# and <tape>.<timestamp>.idx respectively. Each entry is the time a line
+# was written (milliseconds since the epoch, never decreasing) and the
+# offset of the start of the line in the uncompressed tape.
+
+TIME_INDEX_ENTRY = struct.Struct('<qQ')
+
+def time_index_path(segment):
+    name = segment.name[:-len('.gz')] if segment.name.endswith('.gz') else segment.name
+    return segment.with_name(name + '.idx')
+
+def open_segment(segment):
+    return gzip.open(segment, 'rb') if segment.name.endswith('.gz') else segment.open('rb')
+
+def read_time_index(path):
+    # Returns the entries, or None if there is no index. A partly written
+    # last entry is ignored.
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    return list(TIME_INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % TIME_INDEX_ENTRY.size]))
+
+def line_time(line, pattern):
+    # Milliseconds since the epoch from the %t item of a tape line (bytes),
+    # or None
+    matchobj = pattern.match(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+    if matchobj is None or matchobj.group('t') is None:
+        return None
+    try:
+        return int(datetime.datetime.fromisoformat(matchobj.group('t').strip()).timestamp() * 1000)
+    except ValueError:
+        return None
+
+def scan_time_index(segment, pattern, interval, lines, limit=None):
+    # Builds index entries for a tape file (up to byte limit, if given) from
+    # the timestamps in it. pattern is a line_pattern with a t group.
+    entries = []
+    offset = 0
+    last_time = None
+    count = 0
+    with open_segment(segment) as f:
+        for line in f:
+            if limit is not None and offset >= limit:
+                break
+            time_ = line_time(line, pattern)
+            if time_ is not None:
+                if last_time is not None:
+                    time_ = max(time_, last_time)
+                if (last_time is None
+                        or interval and time_ - last_time >= interval * 1000
+                        or lines and count >= lines):
+                    entries.append((time_, offset))
+                    last_time = time_
+                    count = 0
+            count += 1
+            offset += len(line)
+    return entries
+
+def read_time_range(segments, start, end, pattern=None):
+    # Yields the lines of the tape files (oldest first) written from start
+    # to end (datetimes), using their time indexes to skip straight to the
+    # right part of each file. Without an index, a file is scanned if
+    # pattern (a line_pattern) has a t group and read in full otherwise;
+    # the index built by scanning a compressed (and so finished) file is
+    # saved. Lines are only checked against the range if pattern has a t
+    # group; otherwise, the range is only as precise as the index.
+    start_time = int(start.timestamp() * 1000)
+    end_time = int(end.timestamp() * 1000)
+    has_time = pattern is not None and 't' in pattern.groupindex
+    for segment in segments:
+        segment = pathlib.Path(segment)
+        entries = read_time_index(time_index_path(segment))
+        if entries is None:
+            entries = []
+            if has_time:
+                # Same density as the defaults of time_index_interval and time_index_lines
+                entries = scan_time_index(segment, pattern, 60.0, 1000)
+                if segment.name.endswith('.gz'):
+                    write_atomically(time_index_path(segment),
+                                     b''.join(TIME_INDEX_ENTRY.pack(*entry) for entry in entries))
+        # Lines are indexed with the time they were written, which can be
+        # a little after the time they show
+        times = [time_ for time_, _ in entries]
+        before = bisect.bisect_left(times, start_time) - 1
+        begin = entries[before][1] if before >= 0 else 0
+        after = bisect.bisect_right(times, end_time)
+        stop = entries[after][1] if after < len(entries) else None
+        if stop is not None and stop <= begin and not has_time:
+            continue
+        with open_segment(segment) as f:
+            f.seek(begin)
+            offset = begin
+            for line in f:
+                past_stop = stop is not None and offset >= stop
+                if past_stop and not has_time:
+                    break
+                offset += len(line)
+                if has_time:
+                    time_ = line_time(line, pattern)
+                    if time_ is not None and time_ > end_time and past_stop:
+                        break
+                    if time_ is not None and not start_time <= time_ <= end_time:
+                        continue
+                yield line.decode('utf-8', errors='replace')
+
+# Session recordings capture what the plugin sees of each stroke, so that
+# real writing can be replayed through it later (see replay.py). Each
+# session starts with a header line:
+#   {"session": 1, "system": ..., "config": {...}, "dictionaries": [[path, enabled, timestamp, size], ...]}
+# with the settings in effect and the dictionaries in priority order,
+# along with their timestamps and numbers of entries so that a replay can
+# tell if they have changed since, followed by a line for each event:
+#   {"dictionaries": [[path, enabled, timestamp, size], ...]}
+#     The dictionaries changed (including edits through Plover).
+#   {"t": ..., "m": ..., "s": ..., "c": ..., "k": ..., "p": [...]}
+#     A stroke: t is the wall-clock time (ISO 8601), m the monotonic clock
+#     in microseconds, s the raw steno, c whether it is an undo stroke, d
+#     the number of translations dropped from the bottom of the previous
+#     translation stack (if any), k the number of translations kept from
+#     it after that, and p the translations pushed on top of them.
+# Translations are {"r": outline, "e": definition, "f": actions, "x":
+# replaced translations} (replaced translations don't have their own "x").
+# Actions only have the fields in SESSION_ACTION_DEFAULTS, and only where
+# they differ from the default.
+
+SESSION_ACTION_DEFAULTS = {'text': None, 'prev_attach': False, 'prev_replace': '',
+                           'next_attach': False, 'glue': False, 'space_char': ' '}
+
+def encode_translation(translation, replaced=True):
+    encoded = {'r': list(translation.rtfcre),
+               'e': translation.english,
+               'f': [{field: getattr(action, field)
+                      for field, default in SESSION_ACTION_DEFAULTS.items()
+                      if getattr(action, field) != default}
+                     for action in translation.formatting]}
+    if replaced and translation.replaced:
+        encoded['x'] = [encode_translation(old, False) for old in translation.replaced]
+    return encoded
+
+def describe_dictionaries(dictionaries):
+    return [[dictionary.path, dictionary.enabled, dictionary.timestamp, len(dictionary)]
+            for dictionary in dictionaries.dicts]
+
 class ConfigError(Exception):
     pass
 
+OPTIONS = (
+    ('output_file', str, lambda x: True, 'a string', 'tapey_tape.txt'),
+    ('line_format', str, lambda x: True, 'a string', '%b |%S| %D  %s'),
+    ('bar_character', str, lambda x: len(x) == 1, 'a 1-character string', '+'),
+    ('bar_max_width', int, lambda x: True, 'an integer', 5),
+    ('bar_time_unit', float, lambda x: x > 0, 'a positive number', 0.2),
+    ('bar_threshold', float, lambda x: True, 'a number', 0.0),
+    ('bar_alignment', str, lambda x: x in ('left', 'right'), 'either "left" or "right"', 'right'),
+    ('suggestions_marker', str, lambda x: True, 'a string', '>'),
+    ('sinks', list, lambda x: all(isinstance(sink, dict)
+                                  and isinstance(sink.get('output_file'), str)
+                                  and isinstance(sink.get('line_format'), str) for sink in x),
+     'a list of JSON objects with "output_file" and "line_format" strings', []),
+    ('dictionary_names', dict, lambda x: all(isinstance(k, str) and isinstance(v, str) for k, v in x.items()),
+     'a JSON object mapping strings to strings', {}),
+    ('writer_thread', bool, lambda x: True, 'a boolean', False),
+    ('flush_policy', str, lambda x: x in ('every_stroke', 'interval', 'idle'),
+     'one of "every_stroke", "interval", and "idle"', 'every_stroke'),
+    ('flush_interval', float, lambda x: x > 0, 'a positive number', 1.0),
+    ('writer_queue_size', int, lambda x: x > 0, 'a positive integer', 1024),
+    ('suggestions_time_budget', float, lambda x: x >= 0, 'a non-negative number', 0.0),
+    ('suggestions_idle_delay', float, lambda x: x >= 0, 'a non-negative number', 0.5),
+    ('outline_index', bool, lambda x: True, 'a boolean', True),
+    ('reverse_lookup_cache_size', int, lambda x: x >= 0, 'a non-negative integer', 4096),
+    ('record_file', str, lambda x: True, 'a string', ''),
+    ('record_format', str, lambda x: x in ('jsonl', 'binary'), 'either "jsonl" or "binary"', 'jsonl'),
+    ('max_file_size', int, lambda x: x >= 0, 'a non-negative integer', 0),
+    ('rotate_daily', bool, lambda x: True, 'a boolean', False),
+    ('max_archives', int, lambda x: x >= 0, 'a non-negative integer', 0),
+    ('time_index', bool, lambda x: True, 'a boolean', False),
+    ('time_index_interval', float, lambda x: x >= 0, 'a non-negative number', 60.0),
+    ('time_index_lines', int, lambda x: x >= 0, 'a non-negative integer', 1000),
+    ('session_file', str, lambda x: True, 'a string', ''),
+    ('history_size', int, lambda x: x >= 0, 'a non-negative integer', 0),
+    ('publish_socket', str, lambda x: True, 'a string', ''),
+    ('publish_port', int, lambda x: 0 <= x <= 65535, 'an integer between 0 and 65535', 0),
+    ('publish_buffer_size', int, lambda x: x > 0, 'a positive integer', 1000),
+    ('publish_replay_size', int, lambda x: x >= 0, 'a non-negative integer', 100),
+    ('hesitation_stats_file', str, lambda x: True, 'a string', ''),
+    ('hesitation_stats_interval', float, lambda x: x > 0, 'a positive number', 300.0),
+    ('hesitation_stats_size', int, lambda x: x > 0, 'a positive integer', 10000),
+    ('key_stats_file', str, lambda x: True, 'a string', ''),
+    ('key_stats_interval', float, lambda x: x > 0, 'a positive number', 300.0),
+    ('key_stats_chords', int, lambda x: x > 0, 'a positive integer', 1000),
+    ('profile_memory', bool, lambda x: True, 'a boolean', False),
+    ('stats_file', str, lambda x: True, 'a string', ''),
+    ('stats_interval', float, lambda x: x > 0, 'a positive number', 60.0),
+)
+
+def load_config():
+    try:
+        with (CONFIG_DIR / 'tapey_tape.json').open(encoding='utf-8') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    else:
+        if not isinstance(config, dict):
+            raise ConfigError('Settings must be a JSON object')
+
+    settings = {}
+    for option, type_, condition, description, default in OPTIONS:
+        try:
+            value = config[option]
+        except KeyError:
+            value = default
+        else:
+            if not (isinstance(value, type_) and condition(value)):
+                raise ConfigError(f'{option} must be {description}')
+        settings[option] = value
+    return settings
+
+class LookupCache:
+    # Least-recently-used cache in front of a lookup function. It must be
+    # cleared whenever the dictionaries change.
+
+    def __init__(self, function, size):
+        self.function = function
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = self.function(key)
+            if self.size:
+                self.entries[key] = value
+                if len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+def hesitation_bucket(seconds):
+    if seconds < HESITATION_BASE:
+        return 0
+    return min(int(math.log(seconds / HESITATION_BASE, HESITATION_GROWTH)) + 1, HESITATION_BUCKETS - 1)
+
+class HesitationSketch:
+    # Constant-size approximate distribution of hesitation times: counts in
+    # HESITATION_BUCKETS buckets whose bounds grow geometrically from
+    # HESITATION_BASE seconds, so quantiles are accurate to within a factor
+    # of about sqrt(HESITATION_GROWTH). A sketch can be made from the bytes
+    # of a row of counts and its total.
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = array.array('I')
+        self.counts.frombytes(bytes(4 * HESITATION_BUCKETS) if counts is None else counts)
+        self.count = sum(self.counts)
+        self.total = total
+
+    def add(self, seconds):
+        self.counts[hesitation_bucket(seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, fraction):
+        threshold = self.count * fraction
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                if bucket == 0:
+                    return HESITATION_BASE / 2
+                # Geometric middle of the bucket
+                return HESITATION_BASE * HESITATION_GROWTH ** (bucket - 0.5)
+        return 0.0
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': round(self.total / self.count, 3),
+                'p50': round(self.quantile(0.5), 3),
+                'p90': round(self.quantile(0.9), 3)}
+
+class HesitationTable:
+    # Hesitation sketches for the max_keys most recently used keys, kept
+    # as rows of one flat array of bucket counts so that a snapshot only
+    # has to copy a few blocks of memory. A new key takes over the row of
+    # the least recently used one.
+
+    ROW_BYTES = 4 * HESITATION_BUCKETS
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self.rows = collections.OrderedDict() # key -> row
+        self.keys = [None] * max_keys # row -> key
+        self.counts = array.array('I', bytes(self.ROW_BYTES * max_keys))
+        self.sizes = array.array('I', bytes(4 * max_keys))
+        self.totals = array.array('d', bytes(8 * max_keys))
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, key, seconds, sketch=None):
+        # Returns the number of hesitations recorded for key. A key that
+        # isn't in the table starts from sketch if given.
+        row = self.rows.get(key)
+        if row is None:
+            if len(self.rows) < self.max_keys:
+                row = len(self.rows)
+            else:
+                _, row = self.rows.popitem(last=False)
+            self.rows[key] = row
+            self.keys[row] = key
+            start = row * HESITATION_BUCKETS
+            initial = HesitationSketch() if sketch is None else sketch
+            self.counts[start:start + HESITATION_BUCKETS] = initial.counts
+            self.sizes[row] = initial.count
+            self.totals[row] = initial.total
+        else:
+            self.rows.move_to_end(key)
+        self.counts[row * HESITATION_BUCKETS + hesitation_bucket(seconds)] += 1
+        self.sizes[row] += 1
+        self.totals[row] += seconds
+        return self.sizes[row]
+
+    def sketch(self, key):
+        row = self.rows[key]
+        start = row * HESITATION_BUCKETS
+        return HesitationSketch(self.counts[start:start + HESITATION_BUCKETS].tobytes(), self.totals[row])
+
+    def copy(self):
+        # Everything summarize_table needs, cheap to take on the engine thread
+        return self.keys.copy(), self.counts.tobytes(), self.totals.tobytes()
+
+def summarize_table(copy):
+    keys, counts, totals = copy
+    totals = array.array('d', totals)
+    row_bytes = HesitationTable.ROW_BYTES
+    return {key: HesitationSketch(counts[row * row_bytes:(row + 1) * row_bytes], totals[row]).summary()
+            for row, key in enumerate(keys) if key is not None}
+
+class HesitationStats:
+    # Hesitation sketches per outline and per definition. Only the
+    # max_keys most recently used keys of each kind are kept, so memory
+    # stays bounded however varied the writing. Separately, the top
+    # outlines with the highest median hesitation (once written at least
+    # HESITATION_MIN_COUNT times) are ranked as strokes come in, with
+    # sketches of their own that outlast eviction from the table.
+
+    def __init__(self, path, interval, max_keys, top):
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.outlines = HesitationTable(max_keys)
+        self.definitions = HesitationTable(max_keys)
+        self.slowest = {} # outline -> (median, sketch)
+        self.slowest_floor = 0.0 # lowest median in self.slowest
+        self.last_snapshot = time.monotonic()
+        self.snapshot_thread = None
+
+    def add(self, outline, definition, seconds):
+        if seconds > HESITATION_PAUSE:
+            return
+        if definition is not None:
+            self.definitions.add(definition, seconds)
+        if outline is not None:
+            ranked = self.slowest.get(outline)
+            if ranked is None:
+                count = self.outlines.add(outline, seconds)
+                if count >= HESITATION_MIN_COUNT:
+                    self.rank(outline, self.outlines.sketch(outline), None)
+            else:
+                self.outlines.add(outline, seconds, ranked[1])
+                ranked[1].add(seconds)
+                self.rank(outline, ranked[1], ranked[0])
+
+    def rank(self, outline, sketch, previous):
+        # previous is the median outline was ranked with, if it is ranked.
+        # The floor only needs a full scan of self.slowest when the outline
+        # at the floor gets faster or is replaced.
+        median = sketch.quantile(0.5)
+        slowest = self.slowest
+        if previous is not None:
+            if median == previous:
+                return
+            slowest[outline] = (median, sketch)
+            if median < self.slowest_floor:
+                self.slowest_floor = median
+            elif previous == self.slowest_floor:
+                self.slowest_floor = min(value for value, _ in slowest.values())
+        elif len(slowest) < self.top:
+            slowest[outline] = (median, sketch)
+            self.slowest_floor = median if len(slowest) == 1 else min(self.slowest_floor, median)
+        elif median > self.slowest_floor:
+            del slowest[min(slowest, key=lambda key: slowest[key][0])]
+            slowest[outline] = (median, sketch)
+            self.slowest_floor = min(value for value, _ in slowest.values())
+
+    def snapshot_if_due(self):
+        if time.monotonic() - self.last_snapshot >= self.interval:
+            self.snapshot()
+
+    def snapshot(self, wait=False):
+        # Only the raw counts are copied on the calling thread;
+        # summarizing, serializing, and writing happen in the background.
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            if not wait:
+                return # Still writing the last one; try again next stroke
+            self.snapshot_thread.join()
+        self.last_snapshot = time.monotonic()
+        slowest = [(outline, sketch.counts.tobytes(), sketch.total) for outline, (_, sketch) in self.slowest.items()]
+        copies = (slowest, self.outlines.copy(), self.definitions.copy())
+        self.snapshot_thread = threading.Thread(target=self.write_snapshot, args=copies,
+                                                name='tapey_tape_hesitation_snapshot')
+        self.snapshot_thread.start()
+        if wait:
+            self.snapshot_thread.join()
+
+    def write_snapshot(self, slowest, outlines, definitions):
+        slowest = {outline: HesitationSketch(counts, total).summary() for outline, counts, total in slowest}
+        snapshot = {'slowest_outlines': [[outline, slowest[outline]]
+                                         for outline in sorted(slowest, key=lambda outline: slowest[outline]['p50'], reverse=True)],
+                    'outlines': summarize_table(outlines),
+                    'definitions': summarize_table(definitions)}
+        write_atomically(self.path, json.dumps(snapshot, ensure_ascii=False) + '\n')
+
+# Key statistics snapshots are little-endian: the magic bytes b'TTKS',
+# then KEY_STATS_HEADER (format version, number of keys n, number of
+# chords m, number of strokes), the keys (a uint32 length followed by
+# the UTF-8 of the space-separated keys), the press count of each key
+# (n uint64), the co-occurrence counts (n * n uint64, row i column j for
+# keys i < j pressed together), and the chords as bitmasks of key
+# positions (m uint64), their counts (m uint64), and the most each count
+# may be over by (m uint64).
+
+KEY_STATS_MAGIC = b'TTKS'
+KEY_STATS_HEADER = struct.Struct('<IIIQ')
+KEY_STATS_VERSION = 1
+
+def little_endian(counts):
+    # array.array uses the native byte order
+    if sys.byteorder == 'big':
+        counts = array.array(counts.typecode, counts)
+        counts.byteswap()
+    return counts
+
+class KeyCounters:
+    # Key press, key pair, and chord counts in flat arrays indexed by
+    # position in the steno system's keys, so that counting a stroke costs
+    # a few array increments per key. Only the max_chords most frequent
+    # chords are kept, by the Space-Saving algorithm: a new chord takes
+    # the place of the least frequent one and inherits its count, which
+    # is remembered as the most the new count may be over by. To find the
+    # least frequent chord in constant time, the chord slots are kept in
+    # order of count (unused slots first, with a count of 0), along with
+    # the last position of each count in that order; as counts only ever
+    # go up by 1, a slot is moved to the end of its count's run before
+    # its count is incremented, which keeps the order.
+
+    def __init__(self, keys, max_chords):
+        self.keys = tuple(keys)
+        self.positions = {key: position for position, key in enumerate(self.keys)}
+        self.strokes = 0
+        self.presses = array.array('Q', bytes(8 * len(self.keys)))
+        self.pairs = array.array('Q', bytes(8 * len(self.keys) ** 2))
+        self.set_chords([], max_chords)
+
+    def set_chords(self, chords, max_chords):
+        # chords is a list of [chord, count, error], most frequent first;
+        # only the first max_chords are kept
+        chords = sorted(reversed(chords), key=lambda chord: chord[1])[max(len(chords) - max_chords, 0):]
+        unused = [[0, 0, 0]] * (max_chords - len(chords))
+        self.max_chords = max_chords
+        self.chords = array.array('Q', (chord for chord, _, _ in unused + chords))
+        self.chord_counts = array.array('Q', (count for _, count, _ in unused + chords))
+        self.chord_errors = array.array('Q', (error for _, _, error in unused + chords))
+        self.chord_order = array.array('I', range(max_chords)) # slots by count
+        self.chord_places = array.array('I', range(max_chords)) # slot -> position in chord_order
+        self.chord_run_ends = {count: position for position, count in enumerate(self.chord_counts)}
+        self.chord_slots = {self.chords[slot]: slot for slot in range(len(unused), max_chords)}
+
+    def count_chord(self, slot):
+        count = self.chord_counts[slot]
+        position = self.chord_places[slot]
+        end = self.chord_run_ends[count]
+        # Swap with the last slot of the same count
+        other = self.chord_order[end]
+        self.chord_order[position] = other
+        self.chord_places[other] = position
+        self.chord_order[end] = slot
+        self.chord_places[slot] = end
+        if end == 0 or self.chord_counts[self.chord_order[end - 1]] != count:
+            del self.chord_run_ends[count]
+        else:
+            self.chord_run_ends[count] = end - 1
+        if count + 1 not in self.chord_run_ends:
+            self.chord_run_ends[count + 1] = end
+        self.chord_counts[slot] = count + 1
+
+    def add(self, keys):
+        positions = sorted(self.positions[key] for key in keys if key in self.positions)
+        size = len(self.keys)
+        presses = self.presses
+        pairs = self.pairs
+        chord = 0
+        for n, i in enumerate(positions):
+            presses[i] += 1
+            chord |= 1 << i
+            row = i * size
+            for j in positions[n + 1:]:
+                pairs[row + j] += 1
+        self.strokes += 1
+        slot = self.chord_slots.get(chord)
+        if slot is None:
+            # Replace the least frequent chord (or take an unused slot)
+            slot = self.chord_order[0]
+            least = self.chord_counts[slot]
+            if least:
+                del self.chord_slots[self.chords[slot]]
+            self.chord_slots[chord] = slot
+            self.chords[slot] = chord
+            self.chord_errors[slot] = least
+        self.count_chord(slot)
+
+    def pair_count(self, a, b):
+        i, j = sorted((self.positions[a], self.positions[b]))
+        return self.pairs[i * len(self.keys) + j]
+
+    def chord_keys(self, chord):
+        return [key for position, key in enumerate(self.keys) if chord >> position & 1]
+
+    def used_chords(self):
+        # [chord, count, error] of each chord, most frequent first
+        return [[self.chords[slot], self.chord_counts[slot], self.chord_errors[slot]]
+                for slot in reversed(self.chord_order) if self.chord_counts[slot]]
+
+    def top_chords(self, n=None):
+        # The n most frequent chords as [keys, count, most it may be over by]
+        return [[self.chord_keys(chord), count, error] for chord, count, error in self.used_chords()[:n]]
+
+    def encode(self):
+        keys = ' '.join(self.keys).encode('utf-8')
+        chords = self.used_chords()
+        return b''.join((KEY_STATS_MAGIC,
+                         KEY_STATS_HEADER.pack(KEY_STATS_VERSION, len(self.keys), len(chords), self.strokes),
+                         RECORD_LENGTH.pack(len(keys)),
+                         keys,
+                         little_endian(self.presses).tobytes(),
+                         little_endian(self.pairs).tobytes(),
+                         little_endian(array.array('Q', (chord for chord, _, _ in chords))).tobytes(),
+                         little_endian(array.array('Q', (count for _, count, _ in chords))).tobytes(),
+                         little_endian(array.array('Q', (error for _, _, error in chords))).tobytes()))
+
+def decode_key_counters(data, max_chords=None):
+    # The inverse of KeyCounters.encode. Raises ValueError if data isn't a
+    # snapshot.
+    view = memoryview(data)
+    if bytes(view[:len(KEY_STATS_MAGIC)]) != KEY_STATS_MAGIC:
+        raise ValueError('not a key statistics snapshot')
+    position = len(KEY_STATS_MAGIC)
+    try:
+        version, size, chord_count, strokes = KEY_STATS_HEADER.unpack_from(view, position)
+        position += KEY_STATS_HEADER.size
+        if version != KEY_STATS_VERSION:
+            raise ValueError(f'unknown key statistics version {version}')
+        (length,) = RECORD_LENGTH.unpack_from(view, position)
+        position += RECORD_LENGTH.size
+        keys = str(view[position:position + length], 'utf-8').split(' ') if length else []
+        position += length
+    except struct.error as e:
+        raise ValueError('truncated key statistics snapshot') from e
+    if len(keys) != size:
+        raise ValueError('corrupt key statistics snapshot')
+    counters = KeyCounters(keys, 0)
+    counters.strokes = strokes
+    def read_counts(count):
+        nonlocal position
+        end = position + 8 * count
+        if end > len(view):
+            raise ValueError('truncated key statistics snapshot')
+        counts = array.array('Q')
+        counts.frombytes(view[position:end])
+        position = end
+        return little_endian(counts)
+    counters.presses = read_counts(size)
+    counters.pairs = read_counts(size * size)
+    chords = read_counts(chord_count)
+    counts = read_counts(chord_count)
+    errors = read_counts(chord_count)
+    counters.set_chords([list(chord) for chord in zip(chords, counts, errors) if chord[1]],
+                        max(chord_count, 1) if max_chords is None else max_chords)
+    return counters
+
+def read_key_counters(path, max_chords=None):
+    # Loads a snapshot written with the key_stats_file option
+    return decode_key_counters(pathlib.Path(path).read_bytes(), max_chords)
+
+class KeyStats:
+    # Writes KeyCounters to a snapshot file every interval seconds
+
+    def __init__(self, path, interval, counters):
+        self.path = path
+        self.interval = interval
+        self.counters = counters
+        self.last_snapshot = time.monotonic()
+        self.snapshot_thread = None
+
+    def add(self, keys):
+        self.counters.add(keys)
+
+    def snapshot_if_due(self):
+        if time.monotonic() - self.last_snapshot >= self.interval:
+            self.snapshot()
+
+    def snapshot(self, wait=False):
+        # Encoding copies the arrays on the calling thread; writing happens
+        # in the background.
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            if not wait:
+                return # Still writing the last one; try again next stroke
+            self.snapshot_thread.join()
+        self.last_snapshot = time.monotonic()
+        data = self.counters.encode()
+        self.snapshot_thread = threading.Thread(target=write_atomically, args=(self.path, data),
+                                                name='tapey_tape_key_stats_snapshot')
+        self.snapshot_thread.start()
+        if wait:
+            self.snapshot_thread.join()
+
+class StageTimer:
+    # Times the stages of on_stroked into log2-bucketed histograms of
+    # nanoseconds, which cost one list index and a few additions per
+    # sample, and periodically dumps a summary as JSON. The summary is
+    # small and built on the calling thread; serializing and writing it
+    # happen in the background.
+
+    STAGES = ('total', 'dictionary', 'suggestions', 'reverse_lookup', 'format', 'write')
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.histograms = {stage: [0] * 64 for stage in self.STAGES}
+        self.totals = dict.fromkeys(self.STAGES, 0)
+        self.maxima = dict.fromkeys(self.STAGES, 0)
+        self.last_dump = time.monotonic()
+        self.dump_thread = None
+
+    def record(self, stage, nanoseconds):
+        self.histograms[stage][min(nanoseconds.bit_length(), 63)] += 1
+        self.totals[stage] += nanoseconds
+        if nanoseconds > self.maxima[stage]:
+            self.maxima[stage] = nanoseconds
+
+    def percentile(self, stage, fraction):
+        # Upper bound of the bucket containing the percentile
+        histogram = self.histograms[stage]
+        threshold = sum(histogram) * fraction
+        count = 0
+        for bucket, bucket_count in enumerate(histogram):
+            count += bucket_count
+            if count >= threshold:
+                return min(2 ** bucket, self.maxima[stage])
+        return 0
+
+    def summary(self):
+        stages = {}
+        for stage in self.STAGES:
+            count = sum(self.histograms[stage])
+            if not count:
+                continue
+            stages[stage] = {
+                'count': count,
+                'mean_us': self.totals[stage] / count / 1000,
+                'p50_us': self.percentile(stage, 0.5) / 1000,
+                'p99_us': self.percentile(stage, 0.99) / 1000,
+                'max_us': self.maxima[stage] / 1000,
+                'histogram_ns': {f'<{2 ** bucket}': bucket_count
+                                 for bucket, bucket_count in enumerate(self.histograms[stage])
+                                 if bucket_count},
+            }
+        return stages
+
+    def dump_if_due(self, extra):
+        if time.monotonic() - self.last_dump >= self.interval:
+            self.dump(extra)
+
+    def dump(self, extra, wait=False):
+        if self.dump_thread is not None and self.dump_thread.is_alive():
+            if not wait:
+                return # Still writing the last one; try again next stroke
+            self.dump_thread.join()
+        self.last_dump = time.monotonic()
+        summary = {'stages': self.summary(), **extra}
+        self.dump_thread = threading.Thread(target=self.write_summary, args=(summary,),
+                                            name='tapey_tape_stats_dump')
+        self.dump_thread.start()
+        if wait:
+            self.dump_thread.join()
+
+    def write_summary(self, summary):
+        write_atomically(self.path, json.dumps(summary, indent=4) + '\n')
+
+class OutlineIndex:
+    # The fewest strokes each translation can be written in, so that
+    # suggestion keys that can't be written in fewer strokes than were used
+    # can be ruled out without a reverse lookup. The index is built on a
+    # worker thread and brought up to date whenever the dictionaries change;
+    # until it has caught up, table returns None and suggestions fall back
+    # to plain lookups.
+    #
+    # The counts are lower bounds rather than exact: an edited or newly
+    # enabled dictionary is merged into the index, which can only lower
+    # counts, and entries deleted from it or overridden by another
+    # dictionary are left in. That is all that's needed to rule suggestions
+    # out, and it means edits never call for a full rebuild. One only
+    # happens when a dictionary is removed, reloaded, or disabled.
+
+    def __init__(self, dictionaries):
+        self.dictionaries = dictionaries
+        self.fewest_strokes = {}
+        self.merged = {} # id(dictionary) -> (dictionary, signature) as merged
+        self.generation = None # dictionaries_generation the index is up to date with
+        self.wanted = None
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='tapey_tape_outline_index', daemon=True)
+        self.thread.start()
+
+    def table(self, generation):
+        if self.generation == generation:
+            return self.fewest_strokes
+        return None
+
+    def update(self, generation):
+        with self.condition:
+            self.generation = None
+            self.wanted = generation
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.wanted is None and not self.closing:
+                    self.condition.wait()
+                if self.closing:
+                    return
+                generation = self.wanted
+                self.wanted = None
+            self.merge()
+            with self.condition:
+                if self.wanted is None:
+                    self.generation = generation
+
+    def merge(self):
+        dictionaries = list(self.dictionaries.dicts)
+        present = {id(dictionary): dictionary for dictionary in dictionaries if dictionary.enabled}
+        if all(present.get(key) is dictionary for key, (dictionary, _) in self.merged.items()):
+            fewest_strokes = dict(self.fewest_strokes)
+            merged = dict(self.merged)
+        else:
+            fewest_strokes = {}
+            merged = {}
+        for dictionary in present.values():
+            signature = (dictionary.timestamp, len(dictionary))
+            if merged.get(id(dictionary)) == (dictionary, signature):
+                continue
+            # list() copies the entries in one go, before anyone can edit them
+            for outline, translation in list(dictionary.items()):
+                strokes = len(outline)
+                if strokes < fewest_strokes.get(translation, strokes + 1):
+                    fewest_strokes[translation] = strokes
+            merged[id(dictionary)] = (dictionary, signature)
+        self.fewest_strokes = fewest_strokes
+        self.merged = merged
+
+class SuggestionJob:
+    # Suggestions left over when the time budget ran out
+
+    def __init__(self, translations, handled, seen_suggestion_keys, items, record, fewest_strokes):
+        self.translations = translations
+        self.handled = handled
+        self.seen_suggestion_keys = seen_suggestion_keys
+        self.items = items
+        self.record = record
+        self.fewest_strokes = fewest_strokes # never changed once handed out by OutlineIndex
+        self.cancelled = False
+        self.suggestions = []
+
+class SuggestionBackfiller:
+    # Finishes suggestion jobs on a worker thread, but only once no stroke
+    # has come in for idle_delay seconds, so as not to compete with the
+    # engine while the user is writing. Finished jobs are collected by the
+    # engine thread, which is the only one writing to the tape, so their
+    # suggestions only reach it with the next stroke (or at stop).
+
+    def __init__(self, lookup, idle_delay):
+        self.lookup = lookup
+        self.idle_delay = idle_delay
+        self.last_stroke = time.monotonic()
+        self.jobs = queue.Queue(BACKFILL_QUEUE_SIZE)
+        self.finished = collections.deque()
+        self.thread = threading.Thread(target=self.run, name='tapey_tape_backfiller', daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        # Jobs are dropped rather than pile up if the worker can't keep up
+        if self.thread.is_alive():
+            try:
+                self.jobs.put_nowait(job)
+            except queue.Full:
+                pass
+
+    def stroked(self):
+        self.last_stroke = time.monotonic()
+
+    def collect(self):
+        while self.finished:
+            job = self.finished.popleft()
+            if not job.cancelled:
+                yield job
+
+    def close(self):
+        # Finish what's left without waiting
+        self.idle_delay = 0
+        self.jobs.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            while True:
+                remaining = self.last_stroke + self.idle_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(remaining)
+            if job.cancelled:
+                continue
+            tails = enumerate(itertools.islice(tail_suggestion_keys(job.translations), 10), 1)
+            try:
+                collect_suggestions(itertools.islice(tails, job.handled, None),
+                                    self.lookup,
+                                    job.seen_suggestion_keys,
+                                    job.suggestions,
+                                    None,
+                                    job.fewest_strokes)
+            except Exception as e:
+                # e.g., a dictionary changing under the lookup; the job is
+                # given up, but not the ones after it
+                log.warning('tapey tape: could not finish looking for suggestions: %s', e)
+                continue
+            self.finished.append(job)
+
+class TimeIndex:
+    # Maintains the time index of the output file: an entry for the first
+    # line after the file is opened, and then for a line at least every
+    # interval seconds and every `lines` lines (whichever comes first;
+    # 0 turns either off). If the index is missing for a non-empty tape, it
+    # is rebuilt on a worker thread from the timestamps in the tape (if
+    # pattern, a line_pattern, has a t group), and new entries are held
+    # back until that's done.
+
+    def __init__(self, tape_path, interval, lines, pattern):
+        self.tape_path = tape_path
+        self.path = time_index_path(tape_path)
+        self.interval = interval
+        self.lines = lines
+        self.pattern = pattern if pattern is not None and 't' in pattern.groupindex else None
+        self.lock = threading.Lock()
+        self.file = None
+        self.held = []
+        self.rebuilder = None
+        self.last_time = None
+        self.count = 0
+
+    def open(self, size):
+        # Called whenever the tape is opened, with its size
+        self.last_time = None
+        if size and not self.path.exists() and self.pattern is not None:
+            self.rebuilder = threading.Thread(target=self.rebuild, args=(size,), name='tapey_tape_time_index')
+            self.rebuilder.start()
+        else:
+            self.file = self.path.open('ab')
+
+    def rebuild(self, size):
+        entries = scan_time_index(self.tape_path, self.pattern, self.interval, self.lines, size)
+        data = b''.join(TIME_INDEX_ENTRY.pack(*entry) for entry in entries)
+        with self.lock:
+            write_atomically(self.path, data + b''.join(self.held))
+            self.held = []
+            self.file = self.path.open('ab')
+
+    def line(self, offset):
+        # Called at the start of each line of the tape, with its offset
+        time_ = int(time.time() * 1000)
+        if self.last_time is not None:
+            time_ = max(time_, self.last_time)
+            if ((not self.interval or time_ - self.last_time < self.interval * 1000)
+                    and (not self.lines or self.count < self.lines)):
+                self.count += 1
+                return
+        self.last_time = time_
+        self.count = 1
+        entry = TIME_INDEX_ENTRY.pack(time_, offset)
+        with self.lock:
+            if self.file is None:
+                self.held.append(entry)
+            else:
+                self.file.write(entry)
+
+    def rotate(self, archive):
+        # The tape has been renamed to archive; the index goes with it
+        self.close()
+        if self.path.exists():
+            os.replace(self.path, time_index_path(archive))
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        if self.rebuilder is not None:
+            self.rebuilder.join()
+            self.rebuilder = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def tape_archives(path):
+    # The archives TapeFile has rotated path into, oldest first. Only names
+    # with its own timestamps match, not other files that merely start
+    # with the same name (e.g., tapey_tape.txt.audit.<timestamp>.gz).
+    pattern = re.compile(re.escape(path.name) + r'\.(\d{8}-\d{6}-\d{6})(?:-(\d+))?\.gz')
+    archives = []
+    for candidate in path.parent.glob(f'{glob.escape(path.name)}.*.gz'):
+        matchobj = pattern.fullmatch(candidate.name)
+        if matchobj is not None:
+            archives.append((matchobj[1], int(matchobj[2] or 1), candidate))
+    return [archive for _, _, archive in sorted(archives)]
+
+class TapeFile:
+    # The output file, rotated when it grows past max_size bytes (if
+    # max_size is non-zero) or when the day changes (if daily is true).
+    # Rotated segments are renamed to <name>.<timestamp>, gzipped in the
+    # background to <name>.<timestamp>.gz, and pruned down to the newest
+    # max_archives archives (if max_archives is non-zero). Rotation only
+    # ever happens right after a newline, so a line delayed by
+    # fingerspelling is never split across files. If time_index (a
+    # TimeIndex) is given, it is told about every line and rotated along
+    # with the file.
+
+    def __init__(self, path, max_size=0, daily=False, max_archives=0, time_index=None):
+        self.path = path
+        self.max_size = max_size
+        self.daily = daily
+        self.max_archives = max_archives
+        self.time_index = time_index
+        self.compressors = []
+        self.open()
+
+    def open(self):
+        self.file = self.path.open('ab')
+        self.size = self.file.tell()
+        if self.size:
+            self.date = datetime.date.fromtimestamp(self.path.stat().st_mtime)
+        else:
+            self.date = datetime.date.today()
+        self.at_line_start = True
+        if self.time_index is not None:
+            self.time_index.open(self.size)
+
+    def write(self, text):
+        # text can also be bytes holding whole structured records
+        if self.at_line_start and self.size and self.due():
+            self.rotate()
+        if isinstance(text, str):
+            data = text.encode('utf-8')
+            if text:
+                if self.at_line_start and self.time_index is not None:
+                    self.time_index.line(self.size)
+                self.at_line_start = text.endswith('\n')
+        else:
+            data = text
+        self.file.write(data)
+        self.size += len(data)
+
+    def due(self):
+        return (self.max_size and self.size >= self.max_size
+                or self.daily and datetime.date.today() != self.date)
+
+    def rotate(self):
+        self.file.close()
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        archive = self.path.with_name(f'{self.path.name}.{stamp}')
+        number = 1
+        while archive.exists() or archive.with_name(archive.name + '.gz').exists():
+            number += 1
+            archive = self.path.with_name(f'{self.path.name}.{stamp}-{number}')
+        os.replace(self.path, archive)
+        if self.time_index is not None:
+            self.time_index.rotate(archive)
+        self.open()
+        self.compressors = [thread for thread in self.compressors if thread.is_alive()]
+        thread = threading.Thread(target=self.compress, args=(archive,), name='tapey_tape_compressor')
+        thread.start()
+        self.compressors.append(thread)
+
+    def compress(self, archive):
+        compressed = archive.with_name(archive.name + '.gz')
+        temporary = archive.with_name(archive.name + '.gz.tmp')
+        with archive.open('rb') as source, gzip.open(temporary, 'wb') as destination:
+            shutil.copyfileobj(source, destination)
+        os.replace(temporary, compressed)
+        archive.unlink()
+        if self.max_archives:
+            archives = tape_archives(self.path)
+            for old in archives[:-self.max_archives]:
+                old.unlink(missing_ok=True)
+                time_index_path(old).unlink(missing_ok=True)
+
+    def flush(self):
+        self.file.flush()
+        if self.time_index is not None:
+            self.time_index.flush()
+
+    def close(self):
+        self.file.close()
+        if self.time_index is not None:
+            self.time_index.close()
+        for thread in self.compressors:
+            thread.join()
+
+class TapeWriter:
+    # Writes and flushes on the calling thread, i.e., Plover's engine thread.
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, text):
+        self.file.write(text)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ThreadedTapeWriter:
+    # Hands text (or bytes) over to a writer thread through a bounded queue so that a
+    # slow disk (or a network-synced home directory) doesn't hold up stroke
+    # output. Everything that is already in the queue when the thread wakes
+    # up is written in one go, and the file is flushed according to the
+    # flush policy:
+    #   every_stroke  after every batch of writes
+    #   interval      at most once every flush_interval seconds
+    #   idle          once nothing has been written for flush_interval seconds
+
+    def __init__(self, file, flush_policy, flush_interval, queue_size):
+        self.file = file
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(queue_size)
+        self.failing = False
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='tapey_tape_writer', daemon=True)
+        self.thread.start()
+
+    def write(self, text):
+        # Drops the line if the queue is full rather than hold up Plover's
+        # engine thread on a stuck disk
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            if not self.dropped:
+                log.warning('tapey tape: writer queue full, dropping lines')
+            self.dropped += 1
+
+    def close(self):
+        if self.dropped:
+            log.warning('tapey tape: %d lines dropped because the writer fell behind', self.dropped)
+
+        # None tells the writer thread to drain the queue and exit
+        try:
+            self.queue.put(None, timeout=WRITER_TIMEOUT)
+        except queue.Full:
+            log.error('tapey tape: writer stuck, giving up on %d queued lines', self.queue.qsize())
+        else:
+            self.thread.join()
+        try:
+            self.file.close()
+        except OSError as e:
+            log.error('tapey tape: could not close tape: %s', e)
+
+    def attempt(self, operation, *args):
+        # Errors are logged once per run of failures and otherwise ignored,
+        # so the thread keeps draining the queue and a file that comes back
+        # (e.g., a remounted network drive) is written to again.
+        try:
+            operation(*args)
+        except Exception as e:
+            if not self.failing:
+                log.error('tapey tape: could not write tape: %s', e)
+                self.failing = True
+        else:
+            self.failing = False
+
+    def run(self):
+        dirty = False
+        last_flush = time.monotonic()
+        while True:
+            if not dirty or self.flush_policy == 'every_stroke':
+                timeout = None
+            elif self.flush_policy == 'interval':
+                timeout = max(last_flush + self.flush_interval - time.monotonic(), 0)
+            else:
+                timeout = self.flush_interval
+
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                self.attempt(self.file.flush)
+                dirty = False
+                last_flush = time.monotonic()
+                continue
+
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            for text in batch:
+                self.attempt(self.file.write, text)
+
+            if stop:
+                self.attempt(self.file.flush)
+                return
+
+            dirty = True
+
+            if (self.flush_policy == 'every_stroke'
+                    or self.flush_policy == 'interval'
+                    and time.monotonic() - last_flush >= self.flush_interval):
+                self.attempt(self.file.flush)
+                dirty = False
+                last_flush = time.monotonic()
+
+class PublisherClient:
+    # A connected viewer. Lines waiting to be sent are kept in a deque of at
+    # most buffer_size lines, which drops the oldest line when full.
+
+    def __init__(self, sock, lines, buffer_size):
+        self.socket = sock
+        self.lines = collections.deque(lines, buffer_size)
+        self.pending = b'' # taken from lines, partly sent
+        self.dropped = 0
+
+    def extend(self, lines):
+        overflow = len(self.lines) + len(lines) - self.lines.maxlen
+        if overflow > 0:
+            self.dropped += overflow
+        self.lines.extend(lines)
+
+class Publisher:
+    # Streams the paper tape to any number of viewers connected to a
+    # Unix-domain socket at path or, failing that, a TCP socket on
+    # localhost at port. All socket work happens in an event loop on its
+    # own thread. The engine thread only appends complete lines to each
+    # viewer's bounded buffer and never waits on a viewer, so a slow
+    # viewer loses its oldest lines instead of holding up stroke output.
+    # Newly connected viewers first get the last replay_size lines.
+
+    def __init__(self, path, port, buffer_size, replay_size):
+        self.path = path
+        if path is not None:
+            if path.is_socket():
+                path.unlink() # left over from a crash
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(str(path))
+            self.listener.listen()
+        else:
+            self.listener = socket.create_server(('127.0.0.1', port))
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.buffer_size = buffer_size
+        self.replay = collections.deque(maxlen=replay_size)
+        self.partial = ''
+        self.clients = []
+        self.lock = threading.Lock()
+        self.closing = False
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.wakeup_sender.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self.run, name='tapey_tape_publisher', daemon=True)
+        self.thread.start()
+
+    def write(self, text):
+        # Only whole lines are sent, so that dropping lines never leaves a
+        # viewer with half of one
+        text = self.partial + text
+        end = text.rfind('\n') + 1
+        self.partial = text[end:]
+        if not end:
+            return
+        lines = [line.encode('utf-8') + b'\n' for line in text[:end - 1].split('\n')]
+        with self.lock:
+            self.replay.extend(lines)
+            for client in self.clients:
+                client.extend(lines)
+        self.wake()
+
+    def wake(self):
+        try:
+            self.wakeup_sender.send(b'\0')
+        except BlockingIOError:
+            pass # the loop has a wakeup pending already
+
+    def close(self):
+        self.closing = True
+        self.wake()
+        self.thread.join()
+        for client in self.clients:
+            client.socket.close()
+        self.selector.close()
+        self.listener.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+    def run(self):
+        while not self.closing:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.wakeup_receiver:
+                    try:
+                        while self.wakeup_receiver.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self.receive(client)
+                    if events & selectors.EVENT_WRITE and client in self.clients:
+                        self.send(client)
+            for client in self.clients:
+                wanted = selectors.EVENT_READ
+                if client.pending or client.lines:
+                    wanted |= selectors.EVENT_WRITE
+                if self.selector.get_key(client.socket).events != wanted:
+                    self.selector.modify(client.socket, wanted, client)
+
+    def accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except (BlockingIOError, ConnectionAbortedError):
+            return
+        sock.setblocking(False)
+        with self.lock:
+            client = PublisherClient(sock, self.replay, self.buffer_size)
+            self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def receive(self, client):
+        # Viewers aren't expected to send anything; reading only tells us
+        # when they go away
+        try:
+            data = client.socket.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(client)
+
+    def send(self, client):
+        if not client.pending:
+            with self.lock:
+                client.pending = b''.join(client.lines)
+                client.lines.clear()
+        try:
+            sent = client.socket.send(client.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.disconnect(client)
+            return
+        client.pending = client.pending[sent:]
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.remove(client)
+        self.selector.unregister(client.socket)
+        client.socket.close()
+        if client.dropped:
+            log.info('tapey tape: viewer fell behind and missed %d lines', client.dropped)
+
+class SessionRecorder:
+    # Writes a session recording (see above). Translations are compared by
+    # identity with the previous stack, so each one is only written once,
+    # when it's pushed.
+
+    def __init__(self, writer, config, dictionaries):
+        self.writer = writer
+        self.stack = []
+        self.dictionaries = describe_dictionaries(dictionaries)
+        self.write({'session': 1,
+                    'system': plover.system.NAME,
+                    'config': config,
+                    'dictionaries': self.dictionaries})
+
+    def write(self, event):
+        self.writer.write(json.dumps(event, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def dictionaries_changed(self, dictionaries):
+        description = describe_dictionaries(dictionaries)
+        if description != self.dictionaries:
+            self.dictionaries = description
+            self.write({'dictionaries': description})
+
+    def stroked(self, now, monotonic, stroke, translations):
+        # Plover trims the bottom of the stack as well as popping and
+        # pushing translations at the top
+        dropped = len(self.stack)
+        if translations:
+            for i, old in enumerate(self.stack):
+                if old is translations[0]:
+                    dropped = i
+                    break
+        kept = 0
+        for old, new in zip(self.stack[dropped:], translations):
+            if old is not new:
+                break
+            kept += 1
+        event = {'t': now.isoformat(),
+                 'm': int(monotonic * 1000000),
+                 's': stroke.rtfcre,
+                 'c': stroke.is_correction,
+                 'k': kept,
+                 'p': [encode_translation(translation) for translation in translations[kept:]]}
+        if dropped:
+            event['d'] = dropped
+        self.write(event)
+        self.stack = list(translations)
+
+    def close(self):
+        self.writer.close()
+
+class Profiler:
+    # Profiles on_stroked with cProfile and, if memory is true, traces
+    # memory allocations with tracemalloc. When stopped, the results are
+    # written on a background thread to files in Plover's configuration
+    # directory named after the time profiling started:
+    #   tapey_tape_profile_<time>.prof        cProfile data (for pstats, snakeviz, etc.)
+    #   tapey_tape_profile_<time>.txt         the functions that took the longest
+    #   tapey_tape_profile_<time>_memory.txt  where memory was allocated meanwhile
+
+    def __init__(self, memory):
+        self.profile = cProfile.Profile()
+        self.started = datetime.datetime.now()
+        self.strokes = 0
+        self.memory = memory
+        self.started_tracing = False
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.first_snapshot = tracemalloc.take_snapshot()
+
+    def run(self, function, *args):
+        self.strokes += 1
+        return self.profile.runcall(function, *args)
+
+    def stop(self):
+        # Returns the thread writing the results
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            if self.started_tracing:
+                tracemalloc.stop()
+        else:
+            snapshot = None
+        thread = threading.Thread(target=self.write, args=(datetime.datetime.now(), snapshot),
+                                  name='tapey_tape_profiler')
+        thread.start()
+        return thread
+
+    def write(self, stopped, snapshot):
+        stem = f'tapey_tape_profile_{self.started:%Y%m%d-%H%M%S}'
+        self.profile.dump_stats(CONFIG_DIR / f'{stem}.prof')
+        summary = io.StringIO()
+        summary.write(f'{self.strokes} strokes from {self.started:%Y-%m-%d %H:%M:%S} to {stopped:%H:%M:%S}\n')
+        pstats.Stats(self.profile, stream=summary).sort_stats('cumulative').print_stats(50)
+        write_atomically(CONFIG_DIR / f'{stem}.txt', summary.getvalue())
+        if snapshot is not None:
+            lines = [f'Allocations from {self.started:%Y-%m-%d %H:%M:%S} to {stopped:%H:%M:%S}, largest first\n']
+            lines.extend(f'{difference}\n' for difference in snapshot.compare_to(self.first_snapshot, 'lineno')[:50])
+            write_atomically(CONFIG_DIR / f'{stem}_memory.txt', ''.join(lines))
+        log.info('tapey tape: profile written to %s', CONFIG_DIR / f'{stem}.txt')
+
+class TapeSink:
+    # An output file with its own line_format. Lines are split just before
+    # %s, and if the format has %s, the rest of the line of a fingerspelling
+    # stroke is held back until the next stroke shows whether suggestions
+    # should be shown. Text for the file is collected in output and written
+    # in one go by flush.
+
+    def __init__(self, writer, line_format, publisher=None):
+        self.writer = writer
+        self.publisher = publisher
+        left_format, *rest = re.split(r'(\s*%s)', line_format, maxsplit=1)
+        self.left_format = compile_format(left_format)
+        self.right_format = compile_format(''.join(rest))
+        self.codes = {letter for _, letter, _ in self.left_format + self.right_format if letter is not None}
+        self.delays = 's' in self.codes
+        self.pending = False
+        self.output = []
+
+    def add_line(self, items, fingerspelling):
+        self.output.append(format_line(self.left_format, items))
+        if fingerspelling and self.delays:
+            self.pending = True
+        else:
+            self.output.append(format_line(self.right_format, items).rstrip())
+            self.output.append('\n')
+
+    def finish_line(self, items):
+        # Adds back what was held back, if anything
+        if self.pending:
+            self.output.append(format_line(self.right_format, items).rstrip())
+            self.output.append('\n')
+            self.pending = False
+
+    def add_suggestions_line(self, items):
+        # For suggestions found after the fact, which go on a line of their
+        # own, with all the other items blanked out
+        if 's' in self.codes:
+            self.output.append((format_line(self.left_format, items)
+                                + format_line(self.right_format, items)).rstrip() + '\n')
+
+    def flush(self):
+        if self.output:
+            text = ''.join(self.output)
+            self.output.clear()
+            self.writer.write(text)
+            if self.publisher is not None:
+                self.publisher.write(text)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.publisher is not None:
+            self.publisher.close()
+
 class TapeyTape:
+    # The instance that's running, for the tapey_tape_profile command
+    running = None
+
     def __init__(self, engine):
         self.engine = engine
         self.last_stroke_time = None
         self.was_fingerspelling = False
+        self.suggestion_job = None
+        self.profiler = None
 
     def start(self):
-        try:
-            with (CONFIG_DIR / 'tapey_tape.json').open(encoding='utf-8') as f:
-                config = json.load(f)
-        except FileNotFoundError:
-            config = {}
-        else:
-            if not isinstance(config, dict):
-                raise ConfigError('Settings must be a JSON object')
-
-        options = (
-            ('output_file', str, lambda x: True, 'a string', 'tapey_tape.txt'),
-            ('line_format', str, lambda x: True, 'a string', '%b |%S| %D  %s'),
-            ('bar_character', str, lambda x: len(x) == 1, 'a 1-character string', '+'),
-            ('bar_max_width', int, lambda x: True, 'an integer', 5),
-            ('bar_time_unit', float, lambda x: x > 0, 'a positive number', 0.2),
-            ('bar_threshold', float, lambda x: True, 'a number', 0.0),
-            ('bar_alignment', str, lambda x: x in ('left', 'right'), 'either "left" or "right"', 'right'),
-            ('suggestions_marker', str, lambda x: True, 'a string', '>'),
-            ('dictionary_names', dict, lambda x: all(isinstance(k, str) and isinstance(v, str) for k, v in x.items()),
-             'a JSON object mapping strings to strings', {}),
-        )
-
-        self.config = {}
-        for option, type_, condition, description, default in options:
-            try:
-                value = config[option]
-            except KeyError:
-                value = default
+        self.config = load_config()
+
+        if self.config['publish_socket'] and self.config['publish_port']:
+            raise ConfigError('publish_socket and publish_port cannot both be set')
+        if self.config['publish_socket'] or self.config['publish_port']:
+            if self.config['publish_socket']:
+                if not hasattr(socket, 'AF_UNIX'):
+                    raise ConfigError('publish_socket is not supported on this system; use publish_port')
+                path = make_absolute(self.config['publish_socket'])
             else:
-                if not (isinstance(value, type_) and condition(value)):
-                    raise ConfigError(f'{option} must be {description}')
-            self.config[option] = value
+                path = None
+            try:
+                self.publisher = Publisher(path,
+                                           self.config['publish_port'],
+                                           self.config['publish_buffer_size'],
+                                           self.config['publish_replay_size'])
+            except OSError:
+                raise ConfigError('publish_socket or publish_port could not be opened')
+        else:
+            self.publisher = None
+
+        output_file = make_absolute(self.config['output_file'])
+        # Two writers appending to the same file would interleave their lines
+        seen_files = {output_file.resolve()}
+        for number, sink in enumerate(self.config['sinks'], 1):
+            sink_path = make_absolute(sink['output_file']).resolve()
+            if sink_path in seen_files:
+                raise ConfigError(f'output_file of sink {number} is already being written to')
+            seen_files.add(sink_path)
+
+        if self.config['time_index']:
+            time_index = TimeIndex(output_file,
+                                   self.config['time_index_interval'],
+                                   self.config['time_index_lines'],
+                                   line_pattern(self.config['line_format'],
+                                                self.config['suggestions_marker'],
+                                                self.config['bar_max_width']))
+        else:
+            time_index = None
 
         try:
-            self.file = make_absolute(self.config['output_file']).open('a', encoding='utf-8')
+            file = TapeFile(output_file,
+                            self.config['max_file_size'],
+                            self.config['rotate_daily'],
+                            self.config['max_archives'],
+                            time_index)
         except OSError:
             raise ConfigError('output_file could not be opened')
 
-        self.left_format, *rest = re.split(r'(\s*%s)', self.config['line_format'], maxsplit=1)
-        self.right_format = ''.join(rest)
+        self.sinks = [TapeSink(self.make_writer(file), self.config['line_format'], self.publisher)]
+        for number, sink in enumerate(self.config['sinks'], 1):
+            try:
+                sink_file = TapeFile(make_absolute(sink['output_file']),
+                                     self.config['max_file_size'],
+                                     self.config['rotate_daily'],
+                                     self.config['max_archives'])
+            except OSError:
+                raise ConfigError(f'output_file of sink {number} could not be opened')
+            self.sinks.append(TapeSink(self.make_writer(sink_file), sink['line_format']))
+
+        if self.config['record_file']:
+            record_path = make_absolute(self.config['record_file'])
+            binary = self.config['record_format'] == 'binary'
+            try:
+                record_file = TapeFile(record_path)
+                if record_file.size:
+                    with record_path.open('rb') as f:
+                        if (f.read(len(RECORDS_MAGIC)) == RECORDS_MAGIC) != binary:
+                            record_file.close()
+                            raise ConfigError('record_file was written in the other record_format')
+            except OSError:
+                raise ConfigError('record_file could not be opened')
+            self.record_writer = self.make_writer(record_file)
+            if binary and not record_file.size:
+                self.record_writer.write(RECORDS_MAGIC)
+            self.encode_record = encode_binary_record if binary else encode_json_record
+        else:
+            self.record_writer = None
+        self.record = None
+
+        if self.config['session_file']:
+            try:
+                session_file = TapeFile(make_absolute(self.config['session_file']))
+            except OSError:
+                raise ConfigError('session_file could not be opened')
+            self.session_recorder = SessionRecorder(self.make_writer(session_file),
+                                                    self.config,
+                                                    self.engine.dictionaries)
+        else:
+            self.session_recorder = None
+
+        if self.config['history_size']:
+            self.history = TapeHistory(self.config['history_size'])
+        else:
+            self.history = None
+
+        if self.config['stats_file']:
+            self.timer = StageTimer(make_absolute(self.config['stats_file']), self.config['stats_interval'])
+        else:
+            self.timer = None
+
+        # Items are computed once for all sinks
+        self.codes = set().union(*(sink.codes for sink in self.sinks))
+        if self.record_writer is not None or self.history is not None:
+            # Records contain everything
+            self.codes |= ITEM_CODES
 
         self.dictionary_names = {str(make_absolute(filename)): name
                                  for filename, name in self.config['dictionary_names'].items()}
@@ -197,25 +2187,197 @@ class TapeyTape:
         # e.g., 1- -> S-, 2- -> T-, etc.
         self.numbers = {number: letter for letter, number in plover.system.NUMBERS.items()}
 
+        dictionaries = self.engine.dictionaries
+        self.reverse_lookup_cache = LookupCache(dictionaries.reverse_lookup,
+                                                self.config['reverse_lookup_cache_size'])
+        self.dictionary_cache = LookupCache(lambda outline: find_dictionary(dictionaries, outline),
+                                            DICTIONARY_CACHE_SIZE)
+        self.dictionaries_generation = dictionaries_generation(self.engine.dictionaries)
+
+        if 's' in self.codes and self.config['outline_index']:
+            self.outline_index = OutlineIndex(dictionaries)
+            self.outline_index.update(self.dictionaries_generation)
+        else:
+            self.outline_index = None
+
+        if self.config['hesitation_stats_file']:
+            self.hesitation_stats = HesitationStats(make_absolute(self.config['hesitation_stats_file']),
+                                                    self.config['hesitation_stats_interval'],
+                                                    self.config['hesitation_stats_size'],
+                                                    HESITATION_SLOWEST)
+        else:
+            self.hesitation_stats = None
+
+        if self.config['key_stats_file']:
+            if len(plover.system.KEYS) > 64:
+                raise ConfigError('key_stats_file needs a steno system with at most 64 keys')
+            path = make_absolute(self.config['key_stats_file'])
+            try:
+                counters = read_key_counters(path, self.config['key_stats_chords'])
+            except FileNotFoundError:
+                counters = KeyCounters(plover.system.KEYS, self.config['key_stats_chords'])
+            except ValueError as e:
+                raise ConfigError(f'key_stats_file could not be read ({e})')
+            if counters.keys != tuple(plover.system.KEYS):
+                raise ConfigError('key_stats_file was written for a different steno system')
+            self.key_stats = KeyStats(path, self.config['key_stats_interval'], counters)
+        else:
+            self.key_stats = None
+
+        if self.config['suggestions_time_budget']:
+            # The worker thread can't share the cache, which isn't thread-safe
+            self.backfiller = SuggestionBackfiller(dictionaries.reverse_lookup,
+                                                   self.config['suggestions_idle_delay'])
+        else:
+            self.backfiller = None
+
         self.engine.hook_connect('stroked', self.on_stroked)
+        # Not dictionary_state_changed, which is triggered from Plover's
+        # dictionary loading threads; the per-stroke check in process_stroke
+        # catches what it would have.
+        self.engine.hook_connect('dictionaries_loaded', self.on_dictionaries_changed)
+
+        TapeyTape.running = self
 
     def stop(self):
+        self.engine.hook_disconnect('stroked', self.on_stroked)
+        self.engine.hook_disconnect('dictionaries_loaded', self.on_dictionaries_changed)
+
+        if TapeyTape.running is self:
+            TapeyTape.running = None
+
+        profiler_thread = self.stop_profiling()
+        if profiler_thread is not None:
+            profiler_thread.join()
+
+        log.info('tapey tape: reverse lookup cache: %d hits, %d misses',
+                 self.reverse_lookup_cache.hits, self.reverse_lookup_cache.misses)
+        log.info('tapey tape: dictionary cache: %d hits, %d misses',
+                 self.dictionary_cache.hits, self.dictionary_cache.misses)
+
         if self.was_fingerspelling:
-            self.file.write(expand(self.right_format, self.items).rstrip())
-            self.file.write('\n')
+            for sink in self.sinks:
+                sink.finish_line(self.items)
+            if self.record is not None:
+                self.save_record(self.record)
 
-        self.engine.hook_disconnect('stroked', self.on_stroked)
+        if self.outline_index is not None:
+            self.outline_index.close()
 
-        self.file.close()
+        if self.backfiller is not None:
+            self.backfiller.close()
+            self.add_backfilled_lines()
+
+        for sink in self.sinks:
+            sink.close()
+        if self.record_writer is not None:
+            self.record_writer.close()
+        if self.session_recorder is not None:
+            self.session_recorder.close()
+
+        if self.timer is not None:
+            self.timer.dump(self.cache_stats(), wait=True)
+
+        if self.hesitation_stats is not None:
+            self.hesitation_stats.snapshot(wait=True)
+
+        if self.key_stats is not None:
+            self.key_stats.snapshot(wait=True)
+
+    def start_profiling(self):
+        if self.profiler is None:
+            self.profiler = Profiler(self.config['profile_memory'])
+            log.info('tapey tape: profiling started')
+
+    def stop_profiling(self):
+        # Returns the thread writing the results, if profiling
+        if self.profiler is None:
+            return None
+        profiler = self.profiler
+        self.profiler = None
+        return profiler.stop()
+
+    def make_writer(self, file):
+        if self.config['writer_thread']:
+            return ThreadedTapeWriter(file,
+                                      self.config['flush_policy'],
+                                      self.config['flush_interval'],
+                                      self.config['writer_queue_size'])
+        return TapeWriter(file)
+
+    def clock(self):
+        # The wall-clock time, and a monotonic time for measuring hesitation
+        # so that changes to the system clock don't show up as hesitation.
+        # (Overridden to replay recorded sessions.)
+        return datetime.datetime.now(), time.monotonic()
+
+    def save_record(self, record):
+        if self.record_writer is not None:
+            self.record_writer.write(self.encode_record(record))
+        if self.history is not None:
+            self.history.append(record)
+
+    def add_backfilled_lines(self):
+        # A line of its own for the suggestions, which can come many strokes
+        # later, with the items that identify the stroke they belong to
+        for job in self.backfiller.collect():
+            if job.suggestions:
+                items = {letter: value if letter in BACKFILL_ITEMS else ' ' * len(value)
+                         for letter, value in job.items.items()}
+                items['s'] = format_suggestions(job.suggestions, self.config['suggestions_marker'])
+                for sink in self.sinks:
+                    sink.add_suggestions_line(items)
+                if job.record is not None:
+                    suggestions = job.record['suggestions'] + job.suggestions
+                    if self.record_writer is not None:
+                        self.record_writer.write(self.encode_record(
+                            {**job.record, 'suggestions': suggestions, 'backfilled': True}))
+                    if self.history is not None:
+                        self.history.update_suggestions(job.record['time'], job.record['stroke'], suggestions)
+
+    def timed_lookup(self, suggestion_key):
+        lookup_start = time.perf_counter_ns()
+        outlines = self.reverse_lookup_cache.lookup(suggestion_key)
+        self.timer.record('reverse_lookup', time.perf_counter_ns() - lookup_start)
+        return outlines
+
+    def cache_stats(self):
+        return {'caches': {name: {'hits': cache.hits, 'misses': cache.misses, 'size': len(cache.entries)}
+                           for name, cache in (('reverse_lookup', self.reverse_lookup_cache),
+                                               ('dictionary', self.dictionary_cache))}}
+
+    def on_dictionaries_changed(self, *args):
+        self.dictionaries_generation = dictionaries_generation(self.engine.dictionaries)
+        self.reverse_lookup_cache.clear()
+        self.dictionary_cache.clear()
+        if self.outline_index is not None:
+            self.outline_index.update(self.dictionaries_generation)
+        if self.session_recorder is not None:
+            self.session_recorder.dictionaries_changed(self.engine.dictionaries)
 
     def on_stroked(self, stroke):
+        if self.profiler is None:
+            self.process_stroke(stroke)
+        else:
+            self.profiler.run(self.process_stroke, stroke)
+
+    def process_stroke(self, stroke):
         # Do nothing if typing in QWERTY while Plover is off
         if not self.engine.output:
             return
 
+        timer = self.timer
+        if timer is not None:
+            stroke_start = time.perf_counter_ns()
+
         # Translation stack
         translations = self.engine.translator_state.translations
 
+        # Catch dictionary edits that Plover doesn't announce with a hook
+        generation = dictionaries_generation(self.engine.dictionaries)
+        if generation != self.dictionaries_generation:
+            self.on_dictionaries_changed()
+
         # Add back what was delayed
         if self.was_fingerspelling:
             # Some important cases to consider in deciding whether to show suggestions:
@@ -263,34 +2425,74 @@ class TapeyTape:
                     or stroke.is_correction
                     or translations[-1].replaced):
                 self.items['s'] = '' # suppress suggestions
+                if self.record is not None:
+                    self.record['suggestions'] = []
+                if self.suggestion_job is not None:
+                    self.suggestion_job.cancelled = True
 
-            self.file.write(expand(self.right_format, self.items).rstrip())
-            self.file.write('\n')
+            for sink in self.sinks:
+                sink.finish_line(self.items)
 
-        # Bar
-        now  = datetime.datetime.now()
-        time = now.isoformat(sep=' ', timespec='milliseconds')
+            if self.record is not None:
+                self.save_record(self.record)
+
+        if self.backfiller is not None:
+            self.backfiller.stroked()
+            self.add_backfilled_lines()
+            self.suggestion_job = None
+
+        items = {}
+        codes = self.codes
 
+        # Bar
+        now, stroke_time = self.clock()
         if self.last_stroke_time is None:
-            bar = ' ' * self.config['bar_max_width']
+            hesitation = None
+        else:
+            hesitation = stroke_time - self.last_stroke_time
+        self.last_stroke_time = stroke_time
+
+        if self.session_recorder is not None:
+            self.session_recorder.stroked(now, stroke_time, stroke, translations)
+
+        if self.record_writer is None and self.history is None:
+            record = None
         else:
-            seconds = max((now - self.last_stroke_time).total_seconds() - self.config['bar_threshold'], 0)
-            width   = min(int(seconds / self.config['bar_time_unit']), self.config['bar_max_width'])
-            justify = str.ljust if self.config['bar_alignment'] == 'left' else str.rjust
-            bar     = justify(self.config['bar_character'] * width, self.config['bar_max_width'])
+            record = {'time': int(now.timestamp() * 1000),
+                      'hesitation_ms': None if hesitation is None else int(hesitation * 1000)}
+
+        if 't' in codes:
+            items['t'] = now.isoformat(sep=' ', timespec='milliseconds')
 
-        self.last_stroke_time = now
+        if 'b' in codes:
+            if hesitation is None:
+                items['b'] = ' ' * self.config['bar_max_width']
+            else:
+                seconds = max(hesitation - self.config['bar_threshold'], 0)
+                width   = min(int(seconds / self.config['bar_time_unit']), self.config['bar_max_width'])
+                justify = str.ljust if self.config['bar_alignment'] == 'left' else str.rjust
+                items['b'] = justify(self.config['bar_character'] * width, self.config['bar_max_width'])
 
         # Steno
-        keys = set()
-        for key in stroke.steno_keys:
-            if key in self.numbers:                # e.g., if key is 1-
-                keys.add(self.numbers[key])        #   add the corresponding S-
-                keys.add(plover.system.NUMBER_KEY) #   and #
-            else:                                  # if key is S-
-                keys.add(key)                      #   add S-
-        steno = ''.join(key.strip('-') if key in keys else ' ' for key in plover.system.KEYS)
-        raw_steno = stroke.rtfcre
+        if 'S' in codes or self.key_stats is not None:
+            keys = set()
+            for key in stroke.steno_keys:
+                if key in self.numbers:                # e.g., if key is 1-
+                    keys.add(self.numbers[key])        #   add the corresponding S-
+                    keys.add(plover.system.NUMBER_KEY) #   and #
+                else:                                  # if key is S-
+                    keys.add(key)                      #   add S-
+            if self.key_stats is not None:
+                self.key_stats.add(keys)
+            if 'S' in codes:
+                items['S'] = ''.join(key.strip('-') if key in keys else ' ' for key in plover.system.KEYS)
+                if record is not None:
+                    record['keys'] = [key for key in plover.system.KEYS if key in keys]
+
+        if 'r' in codes:
+            items['r'] = stroke.rtfcre
+            if record is not None:
+                record['stroke'] = stroke.rtfcre
 
         # At this point we start to deal with things for which we need to
         # examine the translation stack: output, suggestions, and determining
@@ -309,10 +2511,15 @@ class TapeyTape:
             #   |   K    A  EU     G S  | *intoxication
             #   |          *            | *sandbox
             # is probably not what the user expects.)
-            defined         = '*'
-            translated      = '*'
-            dictionary_name = ''
-            suggestions     = ''
+            items['D'] = '*'
+            items['T'] = '*'
+            items['d'] = ''
+            items['s'] = ''
+            if record is not None:
+                record.update(undo=True, definition=None, translation=None,
+                              corrected=False, dictionary=None, suggestions=[])
+            if self.hesitation_stats is not None and hesitation is not None:
+                self.hesitation_stats.add('*', None, hesitation)
             self.was_fingerspelling = False
         else:
             # We can now rest assured that the translation stack is non-empty.
@@ -329,58 +2536,388 @@ class TapeyTape:
             # pop {.}; it doesn't matter to us, because we can't see it from
             # the snapshots we get on stroked events anyway.)
 
-            definition = translations[-1].english
-            if definition is None:
-                defined = '/'
-            else:
-                defined = star + definition.translate(SHOW_WHITESPACE)
-            # TODO: don't show numbers as untranslate
+            if record is not None:
+                record['undo'] = False
+                record['corrected'] = bool(star)
 
-            translated = star + retroformat(translations[-1]).translate(SHOW_WHITESPACE)
+            if 'D' in codes:
+                definition = translations[-1].english
+                if record is not None:
+                    record['definition'] = definition
+                if definition is None:
+                    items['D'] = '/'
+                else:
+                    items['D'] = star + definition.translate(SHOW_WHITESPACE)
+                # TODO: don't show numbers as untranslate
+
+            if 'T' in codes:
+                translated = retroformat(translations[-1])
+                items['T'] = star + translated.translate(SHOW_WHITESPACE)
+                if record is not None:
+                    record['translation'] = translated
 
             # Dictionary name
-            for dictionary in self.engine.dictionaries.dicts:
-                if translations[-1].rtfcre in dictionary:
-                    dictionary_name = self.dictionary_names.get(dictionary.path, '')
-                    break
-            else:
-                dictionary_name = ''
+            if 'd' in codes:
+                if timer is not None:
+                    stage_start = time.perf_counter_ns()
+                dictionary = self.dictionary_cache.lookup(translations[-1].rtfcre)
+                items['d'] = '' if dictionary is None else self.dictionary_names.get(dictionary.path, '')
+                if record is not None:
+                    record['dictionary'] = None if dictionary is None else dictionary.path
+                if timer is not None:
+                    timer.record('dictionary', time.perf_counter_ns() - stage_start)
 
             # Suggestions
-            chunks = []
-            seen_suggestion_keys = set()
-            for i, tail in enumerate(itertools.islice(tails(translations), 10), 1):
-                outlines = []
-                total_strokes = sum(len(translation.rtfcre) for translation in tail)
-                for suggestion_key in suggestion_keys(tail):
-                    if suggestion_key not in seen_suggestion_keys:
-                        seen_suggestion_keys.add(suggestion_key)
-                        for outline in self.engine.dictionaries.reverse_lookup(suggestion_key):
-                            if len(outline) < total_strokes:
-                                outlines.append(outline)
-                if outlines:
-                    prefix = '' if i == 1 else str(i)
-                    chunks.append(prefix
-                                  + self.config['suggestions_marker']
-                                  + ' '.join(map('/'.join, sorted(outlines, key=len))))
-            suggestions = ' '.join(chunks)
+            if 's' in codes:
+                if timer is not None:
+                    stage_start = time.perf_counter_ns()
+                suggestions = []
+                seen_suggestion_keys = set()
+                tails = enumerate(itertools.islice(tail_suggestion_keys(translations), 10), 1)
+                lookup = self.reverse_lookup_cache.lookup if timer is None else self.timed_lookup
+                if self.outline_index is None:
+                    fewest_strokes = None
+                else:
+                    fewest_strokes = self.outline_index.table(self.dictionaries_generation)
+                if self.backfiller is None:
+                    collect_suggestions(tails, lookup, seen_suggestion_keys, suggestions, None, fewest_strokes)
+                else:
+                    deadline = time.perf_counter() + self.config['suggestions_time_budget']
+                    handled = collect_suggestions(tails, lookup, seen_suggestion_keys, suggestions,
+                                                  deadline, fewest_strokes)
+                    if handled is not None:
+                        # Out of time; the rest is left to the backfiller
+                        self.suggestion_job = SuggestionJob(list(translations), handled,
+                                                            seen_suggestion_keys, items, record, fewest_strokes)
+                        self.backfiller.submit(self.suggestion_job)
+                items['s'] = format_suggestions(suggestions, self.config['suggestions_marker'])
+                if record is not None:
+                    record['suggestions'] = suggestions
+                if timer is not None:
+                    timer.record('suggestions', time.perf_counter_ns() - stage_start)
+
+            if self.hesitation_stats is not None and hesitation is not None:
+                self.hesitation_stats.add('/'.join(translations[-1].rtfcre), translations[-1].english, hesitation)
 
             self.was_fingerspelling = is_fingerspelling(translations[-1])
 
-        self.items = {'t': time,
-                      'b': bar,
-                      'S': steno,
-                      'r': raw_steno,
-                      'D': defined,
-                      'T': translated,
-                      'd': dictionary_name,
-                      's': suggestions,
-                      '%': '%'}
+        self.items = items
+        self.record = record
 
-        self.file.write(expand(self.left_format, self.items))
+        if timer is not None:
+            stage_start = time.perf_counter_ns()
 
-        if not self.was_fingerspelling:
-            self.file.write(expand(self.right_format, self.items).rstrip())
-            self.file.write('\n')
+        for sink in self.sinks:
+            sink.add_line(items, self.was_fingerspelling)
 
-        self.file.flush()
+        if timer is not None:
+            stage_end = time.perf_counter_ns()
+            timer.record('format', stage_end - stage_start)
+            stage_start = stage_end
+
+        for sink in self.sinks:
+            sink.flush()
+
+        if record is not None and not self.was_fingerspelling:
+            self.save_record(record)
+
+        if timer is not None:
+            stage_end = time.perf_counter_ns()
+            timer.record('write', stage_end - stage_start)
+            timer.record('total', stage_end - stroke_start)
+
+        if self.hesitation_stats is not None:
+            self.hesitation_stats.snapshot_if_due()
+
+        if self.key_stats is not None:
+            self.key_stats.snapshot_if_due()
+
+        if timer is not None:
+            timer.dump_if_due(self.cache_stats())
+
+def profile_command(engine, argument):
+    # {:tapey_tape_profile:start}, {:tapey_tape_profile:stop}, and
+    # {:tapey_tape_profile:toggle} (or {:tapey_tape_profile})
+    tapey_tape = TapeyTape.running
+    if tapey_tape is None:
+        log.warning('tapey tape: not running, so there is nothing to profile')
+        return
+    argument = argument.strip().lower() or 'toggle'
+    if argument == 'toggle':
+        argument = 'start' if tapey_tape.profiler is None else 'stop'
+    if argument == 'start':
+        tapey_tape.start_profiling()
+    elif argument == 'stop':
+        tapey_tape.stop_profiling()
+    else:
+        log.error('tapey tape: tapey_tape_profile takes start, stop, or toggle, not %r', argument)
+
+# Offline analysis of tape files
+#
+#   python -m plover_tapey_tape tapey_tape.txt tapey_tape.txt.*.gz
+#
+# Lines are parsed according to line_format (from tapey_tape.json unless
+# given on the command line), so the same layout the plugin writes can be
+# read back. Files are read sequentially in chunks of lines, and the
+# chunks are analysed in a pool of worker processes, each of which only
+# ever holds one chunk and its partial results. Each chunk is preceded by
+# a few lines of context from the previous one so that hesitations and
+# fingerspelled words spanning chunk boundaries are still counted.
+
+CHUNK_CONTEXT = 100
+
+def line_pattern(line_format, marker, bar_max_width):
+    # Returns a regex matching lines written with line_format, with a group
+    # named after each item (only the first occurrence of each).
+    left_format, *rest = re.split(r'(\s*%s)', line_format, maxsplit=1)
+    # Items that always have the same width
+    fixed_widths = {'t': len('2020-02-02 12:34:56.789'), 'b': bar_max_width}
+    seen = set()
+    def pattern(segments):
+        parts = []
+        for text, letter, width in segments:
+            if letter is None:
+                parts.append(re.escape(text))
+            elif letter in fixed_widths:
+                width = max(width, fixed_widths[letter])
+                if letter in seen:
+                    parts.append(f'.{{{width}}}')
+                else:
+                    seen.add(letter)
+                    parts.append(f'(?P<{letter}>.{{{width}}})')
+            elif letter in seen:
+                parts.append(f'.{{{width},}}?')
+            elif letter == 's':
+                # Suggestions always start with the marker, which keeps
+                # them apart from whatever comes before
+                seen.add(letter)
+                parts.append(r'(?P<s>\d*' + re.escape(marker) + '.*?)')
+            else:
+                seen.add(letter)
+                parts.append(f'(?P<{letter}>.{{{width},}}?)')
+        return ''.join(parts)
+    # Trailing whitespace is stripped, so the right part may be cut short
+    return re.compile(pattern(compile_format(left_format))
+                      + '(?:' + pattern(compile_format(''.join(rest))) + r')?\s*$')
+
+def parse_suggestions(text, marker):
+    # '>A B 3>C' -> [(1, ['A', 'B']), (3, ['C'])]
+    suggestions = []
+    for chunk in re.split(r'(?:^|\s+)(?=\d*' + re.escape(marker) + ')', text.strip()):
+        if not chunk:
+            continue
+        count, _, outlines = chunk.partition(marker)
+        suggestions.append((int(count) if count else 1, outlines.split()))
+    return suggestions
+
+def fingerspelled_letter(definition):
+    # 'k' for '{>}{&k}', None if the definition isn't fingerspelling
+    definition = definition.lstrip('*')
+    letters = re.findall(r'\{&([^}]*)\}', definition)
+    if len(letters) != 1 or re.sub(r'\{[^}]*\}', '', definition):
+        return None
+    return letters[0]
+
+def new_analysis():
+    return {'lines': 0,
+            'suggestions': collections.Counter(),
+            'hesitation': {},
+            'fingerspelled': collections.Counter()}
+
+def merge_analyses(total, part):
+    total['lines'] += part['lines']
+    total['suggestions'].update(part['suggestions'])
+    total['fingerspelled'].update(part['fingerspelled'])
+    for outline, (seconds, count) in part['hesitation'].items():
+        total_seconds, total_count = total['hesitation'].get(outline, (0.0, 0))
+        total['hesitation'][outline] = (total_seconds + seconds, total_count + count)
+    return total
+
+def analyze_chunk(job):
+    # Runs in a worker process. The first `context` lines only prime the
+    # state carried from line to line.
+    lines, context, settings = job
+    marker = settings['suggestions_marker']
+    pattern = line_pattern(settings['line_format'], marker, settings['bar_max_width'])
+    max_hesitation = settings['max_hesitation']
+    analysis = new_analysis()
+    last_time = None
+    word = ''
+    word_suggested = False
+    for number, line in enumerate(lines):
+        counted = number >= context
+        matchobj = pattern.match(line.rstrip('\r\n'))
+        if matchobj is None:
+            # e.g., the empty line between files
+            if word and word_suggested and counted:
+                analysis['fingerspelled'][word] += 1
+            word = ''
+            last_time = None
+            continue
+        items = {letter: value.strip() for letter, value in matchobj.groupdict().items() if value is not None}
+        translated = [items[letter] for letter in 'DT' if letter in items]
+        if items.get('s') and translated and not any(translated):
+            # Suggestions found in the background for an earlier stroke, on
+            # a line of their own with only the items identifying the stroke
+            if counted:
+                for translations, outlines in parse_suggestions(items['s'], marker):
+                    analysis['suggestions'][' '.join(outlines)] += 1
+            continue
+        outline = items.get('r') or items.get('S') or items.get('D')
+        if counted:
+            analysis['lines'] += 1
+
+        # Hesitation: from timestamps if available, otherwise from the bar
+        hesitation = None
+        if 't' in items:
+            try:
+                time_ = datetime.datetime.fromisoformat(items['t'])
+            except ValueError:
+                time_ = None
+            if last_time is not None and time_ is not None:
+                hesitation = (time_ - last_time).total_seconds()
+            last_time = time_
+        elif 'b' in items:
+            hesitation = (items['b'].count(settings['bar_character']) * settings['bar_time_unit']
+                          + settings['bar_threshold'])
+        if counted and outline and hesitation is not None and 0 <= hesitation <= max_hesitation:
+            seconds, count = analysis['hesitation'].get(outline, (0.0, 0))
+            analysis['hesitation'][outline] = (seconds + hesitation, count + 1)
+
+        suggestions = parse_suggestions(items.get('s', ''), marker)
+        if counted:
+            for translations, outlines in suggestions:
+                analysis['suggestions'][' '.join(outlines)] += 1
+
+        # Fingerspelled words
+        letter = fingerspelled_letter(items['D']) if 'D' in items else None
+        if letter is None:
+            if word and word_suggested and counted:
+                analysis['fingerspelled'][word] += 1
+            word = ''
+        else:
+            word += letter
+            word_suggested = any(translations == 1 for translations, _ in suggestions)
+    # A word still being spelled at the end is counted by the next chunk
+    return analysis
+
+def read_tape_lines(paths):
+    for path in paths:
+        opener = gzip.open if str(path).endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+            yield from f
+        yield '' # don't let lines from different files run together
+
+def chunk_jobs(lines, chunk_size, settings):
+    context = []
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield context + chunk, len(context), settings
+            context = chunk[-CHUNK_CONTEXT:]
+            chunk = []
+    if chunk:
+        yield context + chunk, len(context), settings
+
+def analyze(paths, settings, workers=None, chunk_size=50000):
+    workers = workers or os.cpu_count() or 1
+    total = new_analysis()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        limit = 2 * workers
+        for job in chunk_jobs(read_tape_lines(paths), chunk_size, settings):
+            # Don't read further ahead than the workers can keep up with
+            if len(pending) >= limit:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    merge_analyses(total, future.result())
+            pending.add(executor.submit(analyze_chunk, job))
+        for future in concurrent.futures.as_completed(pending):
+            merge_analyses(total, future.result())
+    return total
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='tapey-tape-analyze',
+                                     description='Summarize Tapey Tape output files (plain or gzipped).')
+    parser.add_argument('files', nargs='+', type=pathlib.Path)
+    parser.add_argument('-f', '--line-format', help='line_format the files were written with '
+                                                    '(default: from tapey_tape.json)')
+    parser.add_argument('-n', '--top', type=int, default=20, help='number of entries per report')
+    parser.add_argument('--min-count', type=int, default=5,
+                        help='minimum number of strokes for an outline to be reported under hesitation')
+    parser.add_argument('--max-hesitation', type=float, default=10.0,
+                        help='ignore hesitations longer than this many seconds (pauses)')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='lines per chunk')
+    parser.add_argument('--json', action='store_true', help='output JSON')
+    args = parser.parse_args(args)
+
+    settings = load_config()
+    if args.line_format is not None:
+        settings['line_format'] = args.line_format
+    settings['max_hesitation'] = args.max_hesitation
+    settings = {option: settings[option] for option in ('line_format', 'suggestions_marker', 'bar_character',
+                                                        'bar_max_width', 'bar_time_unit', 'bar_threshold',
+                                                        'max_hesitation')}
+
+    analysis = analyze(args.files, settings, args.jobs, args.chunk_size)
+
+    hesitation = sorted(((seconds / count, count, outline)
+                         for outline, (seconds, count) in analysis['hesitation'].items()
+                         if count >= args.min_count),
+                        reverse=True)[:args.top]
+    report = {
+        'lines': analysis['lines'],
+        'missed_suggestions': analysis['suggestions'].most_common(args.top),
+        'slowest_outlines': [(outline, round(average, 3), count) for average, count, outline in hesitation],
+        'fingerspelled_with_entries': analysis['fingerspelled'].most_common(args.top),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=4, ensure_ascii=False))
+        return
+
+    print(f'{report["lines"]} lines')
+    print()
+    print('Most frequent missed suggestions:')
+    for outlines, count in report['missed_suggestions']:
+        print(f'  {count:8}  {outlines}')
+    print()
+    print('Slowest outlines (average hesitation in seconds):')
+    for outline, average, count in report['slowest_outlines']:
+        print(f'  {average:8.3f}  {outline}  ({count} strokes)')
+    print()
+    print('Fingerspelled words that have dictionary entries:')
+    for word, count in report['fingerspelled_with_entries']:
+        print(f'  {count:8}  {word}')
+
+def tape_segments(path):
+    # The rotated archives of a tape file, oldest first, followed by the file
+    return tape_archives(path) + [path]
+
+def seek_main(args=None):
+    parser = argparse.ArgumentParser(prog='tapey-tape-seek',
+                                     description='Print the lines of Tapey Tape output files written in a time range.')
+    parser.add_argument('files', nargs='*', type=pathlib.Path,
+                        help='files to read, oldest first (default: output_file and its archives)')
+    parser.add_argument('--from', dest='start', type=datetime.datetime.fromisoformat, default=datetime.datetime.min,
+                        help='start of the range, e.g., "2024-01-31 14:05"')
+    parser.add_argument('--to', dest='end', type=datetime.datetime.fromisoformat, default=datetime.datetime.max,
+                        help='end of the range')
+    parser.add_argument('-f', '--line-format', help='line_format the files were written with '
+                                                    '(default: from tapey_tape.json)')
+    args = parser.parse_args(args)
+
+    settings = load_config()
+    if args.line_format is not None:
+        settings['line_format'] = args.line_format
+    pattern = line_pattern(settings['line_format'], settings['suggestions_marker'], settings['bar_max_width'])
+    segments = args.files or tape_segments(make_absolute(settings['output_file']))
+    start = max(args.start, datetime.datetime(1970, 1, 2))
+    end = min(args.end, datetime.datetime(9999, 1, 1))
+    for line in read_time_range([segment for segment in segments if segment.exists()], start, end, pattern):
+        sys.stdout.write(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Replays sessions recorded with the session_file option through
+# TapeyTape.on_stroked, using a stand-in engine that plays back the
+# recorded translation stacks and clock readings instead of translating,
+# so the tape comes out the same on every run. Useful for reproducing bugs
+# and for profiling on real writing.
+#
+#   python replay.py session.jsonl                 # as fast as possible
+#   python replay.py session.jsonl --timed         # at the original pace
+#   python replay.py session.jsonl -w golden.txt   # write a golden tape
+#   python replay.py session.jsonl -g golden.txt   # compare with it
+#
+# The dictionaries are loaded from the paths in the recording, with a
+# warning for any that has changed since (going by its timestamp and
+# number of entries), as the tape may then differ. The settings in effect at the time are used, except that nothing is written
+# anywhere but the tape and suggestions have no time budget (which would
+# make the tape depend on timing). A JSON file given with --config can
+# override settings.
+
+import argparse
+import datetime
+import json
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+from plover.registry import registry
+registry.update()
+
+import plover.system
+from plover.dictionary.base import load_dictionary
+from plover.steno import Stroke
+from plover.steno_dictionary import StenoDictionaryCollection
+
+import plover_tapey_tape
+
+# Settings that would make the replay write anywhere but the tape
+REPLAY_SETTINGS = {
+    'session_file': '',
+    'sinks': [],
+    'time_index': False,
+    'record_file': '',
+    'max_file_size': 0,
+    'rotate_daily': False,
+    'publish_socket': '',
+    'publish_port': 0,
+    'hesitation_stats_file': '',
+    'key_stats_file': '',
+    'stats_file': '',
+    'suggestions_time_budget': 0.0,
+}
+
+class ReplayedAction:
+    def __init__(self, fields):
+        for field, default in plover_tapey_tape.SESSION_ACTION_DEFAULTS.items():
+            setattr(self, field, fields.get(field, default))
+
+class ReplayedTranslation:
+    def __init__(self, encoded):
+        self.rtfcre = tuple(encoded['r'])
+        self.strokes = self.rtfcre # only ever counted
+        self.english = encoded['e']
+        self.formatting = [ReplayedAction(fields) for fields in encoded['f']]
+        self.replaced = [ReplayedTranslation(old) for old in encoded.get('x', ())]
+
+class ReplayedTranslatorState:
+    def __init__(self):
+        self.translations = []
+
+class ReplayEngine:
+    # Just enough of plover.engine.StenoEngine for TapeyTape
+
+    def __init__(self):
+        self.output = True
+        self.dictionaries = StenoDictionaryCollection()
+        self.translator_state = ReplayedTranslatorState()
+        self.loaded = {}
+        self.warned = set()
+        self.hooks = {}
+
+    def hook_connect(self, hook, callback):
+        self.hooks.setdefault(hook, []).append(callback)
+
+    def hook_disconnect(self, hook, callback):
+        self.hooks[hook].remove(callback)
+
+    def trigger(self, hook, *args):
+        for callback in self.hooks.get(hook, []):
+            callback(*args)
+
+    def set_dictionaries(self, description):
+        dictionaries = []
+        for path, enabled, *fingerprint in description:
+            if path not in self.loaded:
+                try:
+                    self.loaded[path] = load_dictionary(path)
+                except Exception as e:
+                    print(f'warning: could not load {path}: {e}', file=sys.stderr)
+                    self.loaded[path] = None
+            dictionary = self.loaded[path]
+            if dictionary is not None and fingerprint and (path, *fingerprint) not in self.warned:
+                timestamp, size = fingerprint
+                if (dictionary.timestamp, len(dictionary)) != (timestamp, size):
+                    self.warned.add((path, *fingerprint))
+                    print(f'warning: {path} has changed since it was recorded '
+                          f'({size} entries then, {len(dictionary)} now)', file=sys.stderr)
+            if dictionary is not None:
+                dictionary.enabled = enabled
+                dictionaries.append(dictionary)
+        self.dictionaries.set_dicts(dictionaries)
+        self.trigger('dictionaries_loaded', self.dictionaries)
+
+    def push(self, event):
+        stack = self.translator_state.translations
+        del stack[:event.get('d', 0)]
+        del stack[event['k']:]
+        stack.extend(ReplayedTranslation(encoded) for encoded in event['p'])
+
+class ReplayTapeyTape(plover_tapey_tape.TapeyTape):
+    def clock(self):
+        return self.recorded_clock
+
+def read_sessions(path):
+    # Yields (header, events) for each session in the recording
+    header = None
+    events = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'session' in event:
+                if header is not None:
+                    yield header, events
+                header = event
+                events = []
+            elif header is not None:
+                events.append(event)
+    if header is not None:
+        yield header, events
+
+def replay(path, directory, overrides, timed):
+    # Returns the tape and the time taken by each call to on_stroked
+    plover_tapey_tape.CONFIG_DIR = directory
+    tape = directory / 'tape.txt'
+    samples = []
+    system = None
+    for header, events in read_sessions(path):
+        if header['system'] != system:
+            system = header['system']
+            plover.system.setup(system)
+        config = {**header['config'], **REPLAY_SETTINGS, **overrides, 'output_file': str(tape)}
+        (directory / 'tapey_tape.json').write_text(json.dumps(config), encoding='utf-8')
+        engine = ReplayEngine()
+        engine.set_dictionaries(header['dictionaries'])
+        tapey_tape = ReplayTapeyTape(engine)
+        tapey_tape.start()
+        replay_start = time.perf_counter()
+        first = None
+        for event in events:
+            if 'dictionaries' in event:
+                engine.set_dictionaries(event['dictionaries'])
+                continue
+            if first is None:
+                first = event['m']
+            if timed:
+                delay = replay_start + (event['m'] - first) / 1000000 - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            engine.push(event)
+            stroke = Stroke(event['s'])
+            tapey_tape.recorded_clock = (datetime.datetime.fromisoformat(event['t']),
+                                         event['m'] / 1000000)
+            start = time.perf_counter()
+            tapey_tape.on_stroked(stroke)
+            samples.append(time.perf_counter() - start)
+        tapey_tape.stop()
+    return (tape.read_text(encoding='utf-8') if tape.exists() else ''), samples
+
+def first_difference(expected, actual):
+    expected_lines = expected.splitlines()
+    actual_lines = actual.splitlines()
+    for number, (expected_line, actual_line) in enumerate(zip(expected_lines, actual_lines), 1):
+        if expected_line != actual_line:
+            return number, expected_line, actual_line
+    number = min(len(expected_lines), len(actual_lines)) + 1
+    return (number,
+            expected_lines[number - 1] if number <= len(expected_lines) else '<end of tape>',
+            actual_lines[number - 1] if number <= len(actual_lines) else '<end of tape>')
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded sessions through Tapey Tape.')
+    parser.add_argument('recording', help='file written by the session_file option')
+    parser.add_argument('-t', '--timed', action='store_true', help='replay at the original pace')
+    parser.add_argument('-c', '--config', help='JSON file with settings to override')
+    parser.add_argument('-g', '--golden', help='compare the tape with this golden tape')
+    parser.add_argument('-w', '--write-golden', help='write the tape to this file')
+    args = parser.parse_args()
+
+    overrides = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            overrides = json.load(f)
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        tape, samples = replay(args.recording, pathlib.Path(directory), overrides, args.timed)
+        elapsed = time.perf_counter() - start
+
+    if samples:
+        samples.sort()
+        print(f'{len(samples)} strokes in {elapsed:.2f} s '
+              f'({len(samples) / sum(samples):.0f} strokes/s in on_stroked; '
+              f'mean {statistics.fmean(samples) * 1e6:.1f} us, '
+              f'p50 {samples[len(samples) // 2] * 1e6:.1f} us, '
+              f'p99 {samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1e6:.1f} us, '
+              f'max {samples[-1] * 1e6:.1f} us)')
+    else:
+        print('no strokes recorded')
+
+    if args.write_golden:
+        with open(args.write_golden, 'w', encoding='utf-8') as f:
+            f.write(tape)
+
+    if args.golden:
+        with open(args.golden, encoding='utf-8') as f:
+            golden = f.read()
+        if golden == tape:
+            print('tape matches golden tape')
+        else:
+            number, expected, actual = first_difference(golden, tape)
+            print(f'tape differs from golden tape at line {number}:')
+            print(f'  expected: {expected}')
+            print(f'  actual:   {actual}')
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
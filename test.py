@@ -1,3 +1,11 @@
+import gzip
+import io
+import pathlib
+import random
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 import plover_tapey_tape
@@ -9,6 +17,7 @@ class MockTranslation:
         self.rtfcre = rtfcre
         self.english = english
         self.formatting = formatting
+        self.replaced = []
 
 T = MockTranslation
 A = _Action
@@ -110,5 +119,579 @@ class TestSuggestionKeys(unittest.TestCase):
         self.assertEqual(plover_tapey_tape.suggestion_keys(translations[-1:]), ['{^ing}', '{^}ing'])
         self.assertEqual(plover_tapey_tape.suggestion_keys(translations),      ['smoking'])
 
+class TestTailSuggestionKeys(unittest.TestCase):
+    def assert_equivalent(self, translations):
+        for start in range(len(translations)):
+            for end in range(start + 1, len(translations) + 1):
+                stack = translations[start:end]
+                expected = [(sum(len(translation.rtfcre) for translation in tail),
+                             plover_tapey_tape.suggestion_keys(tail))
+                            for tail in plover_tapey_tape.tails(stack)]
+                self.assertEqual(list(plover_tapey_tape.tail_suggestion_keys(stack)), expected)
+
+    def test_fingerspellings(self):
+        self.assert_equivalent([
+            T(('HE',),   english='he',      formatting=[A(text='he')]),
+            T(('WAS',),  english='was',     formatting=[A(text='was')]),
+            T(('K*',),   english='{>}{&k}', formatting=[A(next_case=Case.LOWER_FIRST_CHAR), A(glue=True, text='k')]),
+            T(('SR*',),  english='{>}{&v}', formatting=[A(glue=True, next_case=Case.LOWER_FIRST_CHAR), A(glue=True, prev_attach=True, text='v')]),
+            T(('*E',),   english='{>}{&e}', formatting=[A(glue=True, next_case=Case.LOWER_FIRST_CHAR), A(glue=True, prev_attach=True, text='e')]),
+            T(('-G',),   english='{^ing}',  formatting=[A(prev_attach=True, text='ing')]),
+            T(('TP-PL',), english='{.}',    formatting=[A(next_case=Case.LOWER_FIRST_CHAR, prev_attach=True, text='.')]),
+        ])
+
+    def test_affixes_with_attach(self):
+        self.assert_equivalent([
+            T(('PHEUD',), english='mid',  formatting=[A(text='mid')]),
+            T(('TK-LS',), english='{^}',  formatting=[A(prev_attach=True, next_attach=True, text='')]),
+            T(('SHEUP',), english='ship', formatting=[A(prev_attach=True, text='ship')]),
+            T(('TK-LS',), english='{^}',  formatting=[A(prev_attach=True, next_attach=True, text='')]),
+            T(('PHAPB',), english='man',  formatting=[A(prev_attach=True, text='man')]),
+        ])
+
+    def test_overbackspacing(self):
+        self.assert_equivalent([
+            T(('AOUPB', 'TAOEUTD'), english='united', formatting=[A(text='united')]),
+            T(('STAEUTS',),         english='states', formatting=[A(text='states')]),
+            T(('KA*PD',),           english='{:retro_title:2}',
+              formatting=[A(prev_attach=True, prev_replace='united states', text='United States')]),
+            T(('SPHOEBG',),         english='smoke',  formatting=[A(text='smoke')]),
+            T(('-G',),              english='{^ing}', formatting=[A(prev_attach=True, prev_replace='e', text='ing')]),
+        ])
+
+    def test_random(self):
+        rng = random.Random(0)
+        def action():
+            return A(text=rng.choice([None, '', 'a', 'Bc', 'def']),
+                     prev_attach=rng.random() < 0.4,
+                     next_attach=rng.random() < 0.2,
+                     glue=rng.random() < 0.3,
+                     prev_replace='x' * rng.choice([0, 0, 0, 1, 2, 5]),
+                     space_char=rng.choice([' ', '_']))
+        def translation():
+            return T(('S',) * rng.randint(1, 3),
+                     english=rng.choice([None, 'x', '{^x}', '{x^}', '{^x^}', 'aB', '{*-|}', '{:retro_title:2}']),
+                     formatting=[action() for _ in range(rng.choice([0, 1, 1, 2, 3]))])
+        for _ in range(200):
+            self.assert_equivalent([translation() for _ in range(rng.randint(1, 8))])
+
+class TestCompileFormat(unittest.TestCase):
+    def test_same_as_expand(self):
+        items = {'t': '2020-02-02 12:34:56.789',
+                 'b': '  +++',
+                 'S': '   K W R    U R PB      ',
+                 'r': 'KWRURPB',
+                 'D': 'yes{,}your Honor',
+                 'T': 'Yes, your Honor',
+                 'd': 'main',
+                 's': '2>KWRURPB',
+                 '%': '%'}
+        for format_string in ['%b |%S| %D  %s',
+                              '%10r -> %T',
+                              '%t %r %T %d %s',
+                              '%%%5%%3% 100%',
+                              '%x %5y %12D|%0T%',
+                              '',
+                              'no codes']:
+            self.assertEqual(plover_tapey_tape.format_line(plover_tapey_tape.compile_format(format_string), items),
+                             plover_tapey_tape.expand(format_string, items))
+
+class TestHesitationStats(unittest.TestCase):
+    def test_sketch_quantiles(self):
+        sketch = plover_tapey_tape.HesitationSketch()
+        for i in range(1, 1001):
+            sketch.add(i / 1000) # 1 ms to 1 s
+        self.assertEqual(sketch.count, 1000)
+        for fraction in (0.5, 0.9):
+            estimate = sketch.quantile(fraction)
+            self.assertLess(abs(estimate - fraction) / fraction, 0.2)
+
+    def test_bounded(self):
+        stats = plover_tapey_tape.HesitationStats(None, 60.0, 3, 10)
+        for i in range(10):
+            stats.add(f'OUT{i}', f'word{i}', 0.5)
+        stats.add('OUT9', None, 20.0) # a pause, ignored
+        self.assertEqual(list(stats.outlines.rows), ['OUT7', 'OUT8', 'OUT9'])
+        self.assertEqual(list(stats.definitions.rows), ['word7', 'word8', 'word9'])
+        self.assertEqual(stats.outlines.sketch('OUT9').count, 1)
+
+    def test_slowest_survive_eviction(self):
+        stats = plover_tapey_tape.HesitationStats(None, 60.0, 3, 2)
+        for _ in range(5):
+            stats.add('SLOW', None, 2.0)
+            stats.add('SLOWER', None, 4.0)
+        for i in range(10):
+            for _ in range(5):
+                stats.add(f'FAST{i}', None, 0.1)
+        self.assertNotIn('SLOW', stats.outlines)
+        self.assertEqual(list(stats.slowest), ['SLOW', 'SLOWER'])
+        stats.add('SLOW', None, 2.0) # carries on with the ranked sketch
+        self.assertEqual(stats.outlines.sketch('SLOW').count, 6)
+        self.assertEqual(stats.slowest['SLOW'][1].count, 6)
+        for _ in range(5):
+            stats.add('SLOWEST', None, 8.0)
+        self.assertEqual(set(stats.slowest), {'SLOWER', 'SLOWEST'})
+
+    def test_snapshot_skipped_while_writing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'hesitation.json'
+            stats = plover_tapey_tape.HesitationStats(path, 60.0, 3, 2)
+            stats.add('OUT', None, 0.5)
+            writing = threading.Event()
+            stats.snapshot_thread = threading.Thread(target=writing.wait)
+            stats.snapshot_thread.start()
+            last_snapshot = stats.last_snapshot
+            stats.snapshot()
+            self.assertEqual(stats.last_snapshot, last_snapshot)
+            self.assertFalse(path.exists())
+            writing.set()
+            stats.snapshot(wait=True)
+            self.assertIn('OUT', path.read_text())
+
+class TestKeyCounters(unittest.TestCase):
+    def test_counts(self):
+        counters = plover_tapey_tape.KeyCounters(['S-', 'T-', 'A-', '-E'], 2)
+        for keys in [{'S-', 'A-'}] * 3 + [{'T-', 'A-', '-E'}, {'S-'}, {'-E', 'X-'}]:
+            counters.add(keys)
+        self.assertEqual(counters.strokes, 6)
+        self.assertEqual(list(counters.presses), [4, 1, 4, 2])
+        self.assertEqual(counters.pair_count('A-', 'S-'), 3)
+        self.assertEqual(counters.pair_count('T-', '-E'), 1)
+        self.assertEqual(counters.pair_count('S-', '-E'), 0)
+        # S- replaced T-A-E, then -E replaced S-, each inheriting its count
+        self.assertEqual(counters.top_chords(), [[['S-', 'A-'], 3, 0], [['-E'], 3, 2]])
+
+    def test_snapshot_round_trip(self):
+        keys = ['#', 'S-', 'T-', 'K-', 'P-', 'W-', 'H-', 'R-', 'A-', 'O-', '*',
+                '-E', '-U', '-F', '-R', '-P', '-B', '-L', '-G', '-T', '-S', '-D', '-Z']
+        counters = plover_tapey_tape.KeyCounters(keys, 100)
+        rng = random.Random(0)
+        for _ in range(1000):
+            counters.add(set(rng.sample(keys, rng.randint(1, 6))))
+        # Space-Saving keeps the counts adding up to the number of strokes
+        self.assertEqual(sum(count for _, count, _ in counters.top_chords()), 1000)
+        decoded = plover_tapey_tape.decode_key_counters(counters.encode())
+        self.assertEqual(decoded.keys, counters.keys)
+        self.assertEqual(decoded.strokes, 1000)
+        self.assertEqual(decoded.presses, counters.presses)
+        self.assertEqual(decoded.pairs, counters.pairs)
+        self.assertEqual(decoded.top_chords(), counters.top_chords())
+        trimmed = plover_tapey_tape.decode_key_counters(counters.encode(), 10)
+        self.assertEqual(trimmed.top_chords(), counters.top_chords(10))
+        with self.assertRaises(ValueError):
+            plover_tapey_tape.decode_key_counters(counters.encode()[:100])
+
+class TestStageTimer(unittest.TestCase):
+    def test_summary(self):
+        timer = plover_tapey_tape.StageTimer(None, 60.0)
+        for nanoseconds in [1000] * 98 + [5000, 900000]:
+            timer.record('total', nanoseconds)
+        summary = timer.summary()
+        self.assertEqual(list(summary), ['total'])
+        self.assertEqual(summary['total']['count'], 100)
+        self.assertEqual(summary['total']['p50_us'], 1.024)
+        self.assertEqual(summary['total']['p99_us'], 8.192)
+        self.assertEqual(summary['total']['max_us'], 900.0)
+        self.assertEqual(summary['total']['histogram_ns'], {'<1024': 98, '<8192': 1, '<1048576': 1})
+
+    def test_dump(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'stats.json'
+            timer = plover_tapey_tape.StageTimer(path, 60.0)
+            timer.record('write', 2000)
+            timer.dump({'cache': 1}, wait=True)
+            dumped = plover_tapey_tape.json.loads(path.read_text())
+            self.assertEqual(dumped['cache'], 1)
+            self.assertEqual(dumped['stages']['write']['count'], 1)
+
+class MockDictionaries:
+    def __init__(self):
+        self.lookups = []
+
+    def reverse_lookup(self, key):
+        self.lookups.append(key)
+        return {(key.upper(),)}
+
+class TestCollectSuggestions(unittest.TestCase):
+    tails = [(1, (1, ['man'])), (2, (3, ['{^shipman}', '{^}shipman'])), (3, (4, ['midshipman']))]
+
+    def lookup(self, key):
+        return {'midshipman': [('PHEUD', 'SHEUP', 'PHAPB'), ('PHEURB',)], 'man': [('PHAPB',)]}.get(key, [])
+
+    def test_complete(self):
+        suggestions = []
+        self.assertIsNone(plover_tapey_tape.collect_suggestions(iter(self.tails), self.lookup, set(), suggestions))
+        self.assertEqual(suggestions, [[3, ['PHEURB', 'PHEUD/SHEUP/PHAPB']]])
+        self.assertEqual(plover_tapey_tape.format_suggestions(suggestions, '>'), '3>PHEURB PHEUD/SHEUP/PHAPB')
+
+    def test_out_of_time(self):
+        suggestions = []
+        tails = iter(self.tails)
+        self.assertEqual(plover_tapey_tape.collect_suggestions(tails, self.lookup, set(), suggestions, 0), 0)
+        self.assertEqual(suggestions, [])
+
+class MockDictionary(dict):
+    enabled = True
+    timestamp = 0
+
+class MockCollection:
+    def __init__(self, *dicts):
+        self.dicts = list(dicts)
+
+class TestOutlineIndex(unittest.TestCase):
+    def wait(self, index, generation):
+        for _ in range(500):
+            table = index.table(generation)
+            if table is not None:
+                return table
+            time.sleep(0.01)
+        self.fail('index not ready')
+
+    def test_merge_and_rebuild(self):
+        main = MockDictionary({('PHEUD', 'SHEUP', 'PHAPB'): 'midshipman', ('PHAPB',): 'man'})
+        user = MockDictionary()
+        collection = MockCollection(user, main)
+        index = plover_tapey_tape.OutlineIndex(collection)
+        try:
+            self.assertIsNone(index.table(1))
+            index.update(1)
+            self.assertEqual(self.wait(index, 1), {'midshipman': 3, 'man': 1})
+            user[('PHEURB',)] = 'midshipman'
+            index.update(2)
+            self.assertIsNone(index.table(1))
+            self.assertEqual(self.wait(index, 2), {'midshipman': 1, 'man': 1})
+            user.enabled = False
+            index.update(3)
+            self.assertEqual(self.wait(index, 3), {'midshipman': 3, 'man': 1})
+        finally:
+            index.close()
+
+    def test_collect_suggestions(self):
+        tails = [(1, (1, ['man'])), (2, (3, ['midshipman']))]
+        lookups = []
+        def lookup(key):
+            lookups.append(key)
+            return [('PHEURB',)]
+        suggestions = []
+        plover_tapey_tape.collect_suggestions(iter(tails), lookup, set(), suggestions, None,
+                                              {'man': 1, 'midshipman': 1})
+        self.assertEqual(suggestions, [[2, ['PHEURB']]])
+        self.assertEqual(lookups, ['midshipman'])
+
+class TestLookupCache(unittest.TestCase):
+    def test_hits_and_eviction(self):
+        dictionaries = MockDictionaries()
+        cache = plover_tapey_tape.LookupCache(dictionaries.reverse_lookup, 2)
+        for key in ['the', 'of', 'the', 'and', 'of', 'the']:
+            self.assertEqual(cache.lookup(key), {(key.upper(),)})
+        self.assertEqual(dictionaries.lookups, ['the', 'of', 'and', 'of', 'the'])
+        self.assertEqual((cache.hits, cache.misses), (1, 5))
+
+    def test_clear(self):
+        dictionaries = MockDictionaries()
+        cache = plover_tapey_tape.LookupCache(dictionaries.reverse_lookup, 10)
+        cache.lookup('the')
+        cache.clear()
+        cache.lookup('the')
+        self.assertEqual(dictionaries.lookups, ['the', 'the'])
+
+class MockFile(io.StringIO):
+    def close(self):
+        self.final_value = self.getvalue()
+        super().close()
+
+class TestProfiler(unittest.TestCase):
+    def test_files(self):
+        config_dir = plover_tapey_tape.CONFIG_DIR
+        with tempfile.TemporaryDirectory() as directory:
+            plover_tapey_tape.CONFIG_DIR = pathlib.Path(directory)
+            try:
+                profiler = plover_tapey_tape.Profiler(True)
+                for i in range(3):
+                    self.assertEqual(profiler.run(sorted, [i, 2, 1]), sorted([i, 2, 1]))
+                profiler.stop().join()
+            finally:
+                plover_tapey_tape.CONFIG_DIR = config_dir
+            self.assertEqual(len(list(pathlib.Path(directory).iterdir())), 3)
+            summary = next(pathlib.Path(directory).glob('*[0-9].txt')).read_text(encoding='utf-8')
+            self.assertTrue(summary.startswith('3 strokes'))
+            self.assertIn('sorted', summary)
+
+class TestThreadedTapeWriter(unittest.TestCase):
+    def test_close_drains_queue(self):
+        for flush_policy in ('every_stroke', 'interval', 'idle'):
+            file = MockFile()
+            writer = plover_tapey_tape.ThreadedTapeWriter(file, flush_policy, 60.0, 1000)
+            lines = [f'line {i}\n' for i in range(100)]
+            for line in lines:
+                writer.write(line)
+            writer.write('delayed')
+            writer.close()
+            self.assertEqual(file.final_value, ''.join(lines) + 'delayed')
+
+    def test_write_errors(self):
+        class FailingFile(MockFile):
+            def write(self, text):
+                if text.startswith('bad'):
+                    raise OSError('disk gone')
+                return super().write(text)
+        file = FailingFile()
+        writer = plover_tapey_tape.ThreadedTapeWriter(file, 'every_stroke', 60.0, 1000)
+        for i in range(20):
+            writer.write(f'bad {i}\n' if i < 10 else f'line {i}\n')
+        writer.close()
+        self.assertEqual(file.final_value, ''.join(f'line {i}\n' for i in range(10, 20)))
+
+    def test_full_queue_drops(self):
+        stuck = threading.Event()
+        class StuckFile(MockFile):
+            def write(self, text):
+                stuck.wait()
+                return super().write(text)
+        file = StuckFile()
+        writer = plover_tapey_tape.ThreadedTapeWriter(file, 'every_stroke', 60.0, 2)
+        start = time.monotonic()
+        for i in range(10):
+            writer.write(f'line {i}\n')
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertGreaterEqual(writer.dropped, 7)
+        stuck.set()
+        writer.close()
+        self.assertEqual(len(file.final_value.splitlines()), 10 - writer.dropped)
+
+class TestTapeSink(unittest.TestCase):
+    def test_delay_only_with_suggestions(self):
+        with_suggestions = plover_tapey_tape.TapeSink(plover_tapey_tape.TapeWriter(MockFile()), '%D  %s')
+        without = plover_tapey_tape.TapeSink(plover_tapey_tape.TapeWriter(MockFile()), '%D')
+        self.assertEqual(without.codes, {'D'})
+        sinks = (with_suggestions, without)
+        items = {'D': '{>}{&a}', 's': '>A'}
+        for sink in sinks:
+            sink.add_line(items, True)
+            sink.flush()
+        self.assertEqual(with_suggestions.writer.file.getvalue(), '{>}{&a}')
+        self.assertEqual(without.writer.file.getvalue(), '{>}{&a}\n')
+        items['s'] = ''
+        for sink in sinks:
+            sink.finish_line(items)
+            sink.add_suggestions_line({'D': '       ', 's': '>B'})
+            sink.close()
+        self.assertEqual(with_suggestions.writer.file.final_value, '{>}{&a}\n         >B\n')
+        self.assertEqual(without.writer.file.final_value, '{>}{&a}\n')
+
+class TestRecords(unittest.TestCase):
+    def test_binary_round_trip(self):
+        records = [
+            {'time': 1700000000123, 'hesitation_ms': None, 'undo': False, 'corrected': True,
+             'stroke': 'KWRURPB', 'keys': ['K-', 'W-', 'R-', '-U', '-R', '-P', '-B'],
+             'definition': 'yes{,}your Honor', 'translation': 'Yes, your Honor',
+             'dictionary': '/home/user/main.json', 'suggestions': [[1, ['KWRURPB']], [3, ['KWR*URPB', 'KWRUR/PB']]]},
+            {'time': 1700000000456, 'hesitation_ms': 333, 'undo': True, 'corrected': False,
+             'stroke': '*', 'keys': ['*'],
+             'definition': None, 'translation': None, 'dictionary': None, 'suggestions': []},
+            {'time': 1700000000789, 'hesitation_ms': 0, 'undo': False, 'corrected': False,
+             'stroke': 'TEFT', 'keys': [],
+             'definition': None, 'translation': 'TEFT ünïcödé', 'dictionary': None, 'suggestions': []},
+            {'time': 1700000000123, 'hesitation_ms': None, 'undo': False, 'corrected': False,
+             'stroke': 'KWRURPB', 'keys': [], 'definition': None, 'translation': None,
+             'dictionary': None, 'suggestions': [[1, ['KWRURPB']]], 'backfilled': True},
+            {'time': 1700000001000, 'hesitation_ms': 211, 'undo': False, 'corrected': False,
+             'stroke': 'S', 'keys': ['S-'], 'definition': 'is', 'translation': 'is', 'dictionary': None,
+             'suggestions': [[300, [f'S{i}' for i in range(256)]]] * 256},
+        ]
+        data = b''.join(map(plover_tapey_tape.encode_binary_record, records))
+        self.assertEqual(list(plover_tapey_tape.decode_binary_records(data)), records)
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'records'
+            # A first record 123 bytes long starts with b'{'
+            first = dict(records[2], definition='x' * 82, translation=None)
+            self.assertEqual(plover_tapey_tape.encode_binary_record(first)[:1], b'{')
+            path.write_bytes(plover_tapey_tape.RECORDS_MAGIC + plover_tapey_tape.encode_binary_record(first) + data)
+            self.assertEqual(plover_tapey_tape.read_records(path), [first] + records)
+            path.write_text(''.join(map(plover_tapey_tape.encode_json_record, records)), encoding='utf-8')
+            self.assertEqual(plover_tapey_tape.read_records(path), records)
+
+class TestTapeHistory(unittest.TestCase):
+    def record(self, time, suggestions=()):
+        return {'time': time, 'stroke': 'S', 'keys': ['S-'], 'hesitation_ms': None, 'undo': False,
+                'definition': 'is', 'translation': 'is', 'corrected': False, 'dictionary': None,
+                'suggestions': list(suggestions)}
+
+    def test_queries(self):
+        history = plover_tapey_tape.TapeHistory(4)
+        self.assertEqual(history.last(3), [])
+        for time in range(1000, 7000, 1000):
+            history.append(self.record(time, [[1, ['S']]] if time in (2000, 5000) else []))
+        self.assertEqual([entry.time for entry in history.last(10)], [3000, 4000, 5000, 6000])
+        self.assertEqual([entry.time for entry in history.last(2)], [5000, 6000])
+        self.assertEqual([entry.time for entry in history.since(4.5)], [5000, 6000])
+        self.assertEqual([entry.time for entry in history.with_suggestions()], [5000])
+        self.assertEqual(history.last(1)[0].suggestions, ())
+        history.update_suggestions(4000, 'S', [[2, ['S/S']]])
+        self.assertEqual([entry.suggestions for entry in history.with_suggestions()], [((2, ('S/S',)),), ((1, ('S',)),)])
+
+class MockStroke:
+    def __init__(self, rtfcre):
+        self.rtfcre = rtfcre
+        self.is_correction = rtfcre == '*'
+
+class TestSessionRecorder(unittest.TestCase):
+    def test_stack_changes(self):
+        a, b, c = (T((steno,), steno.lower(), [_Action(text=steno.lower())]) for steno in 'ABC')
+        c.replaced = [T(('X',), None, [_Action(text='X', prev_attach=True)])]
+        writer = plover_tapey_tape.TapeWriter(MockFile())
+        recorder = plover_tapey_tape.SessionRecorder(writer, {'line_format': '%S'}, MockCollection())
+        now = plover_tapey_tape.datetime.datetime(2024, 1, 31, 9, 30)
+        for steno, stack in (('A', [a]), ('B', [a, b]), ('C', [b, c]), ('*', [b])):
+            recorder.stroked(now, 1.5, MockStroke(steno), stack)
+        recorder.close()
+        header, *events = map(plover_tapey_tape.json.loads, writer.file.final_value.splitlines())
+        self.assertEqual(header['config'], {'line_format': '%S'})
+        self.assertEqual([(event.get('d', 0), event['k'], len(event['p'])) for event in events],
+                         [(0, 0, 1), (0, 1, 1), (1, 1, 1), (0, 1, 0)])
+        self.assertEqual(events[2]['p'], [{'r': ['C'], 'e': 'c', 'f': [{'text': 'c'}],
+                                           'x': [{'r': ['X'], 'e': None, 'f': [{'text': 'X', 'prev_attach': True}]}]}])
+        self.assertEqual(events[0]['t'], '2024-01-31T09:30:00')
+        self.assertTrue(events[3]['c'])
+
+    def test_dictionary_edits(self):
+        main = MockDictionary({('HEL',): 'hello'})
+        main.path = 'main.json'
+        writer = plover_tapey_tape.TapeWriter(MockFile())
+        collection = MockCollection(main)
+        recorder = plover_tapey_tape.SessionRecorder(writer, {}, collection)
+        recorder.dictionaries_changed(collection)
+        main[('WORLD',)] = 'world'
+        main.timestamp = 1
+        recorder.dictionaries_changed(collection)
+        recorder.close()
+        header, *events = map(plover_tapey_tape.json.loads, writer.file.final_value.splitlines())
+        self.assertEqual(header['dictionaries'], [['main.json', True, 0, 1]])
+        self.assertEqual(events, [{'dictionaries': [['main.json', True, 1, 2]]}])
+
+class TestAnalyzeChunk(unittest.TestCase):
+    settings = {'line_format': '%t %b |%r| %D  %s',
+                'suggestions_marker': '>',
+                'bar_character': '+',
+                'bar_max_width': 3,
+                'bar_time_unit': 0.2,
+                'bar_threshold': 0.0,
+                'max_hesitation': 10.0}
+
+    lines = [
+        '2020-02-02 12:00:00.000     |HEL| hello',
+        '2020-02-02 12:00:00.500   + |K*| {>}{&k}',
+        '2020-02-02 12:00:01.000   + |SR*| {>}{&v}',
+        '2020-02-02 12:00:02.000 +++ |*E| {>}{&e}  >KW*EFP',
+        '2020-02-02 12:00:02.250     |HEL| hello',
+        '2020-02-02 12:00:03.000   + |PER| per',
+        '2020-02-02 12:00:03.500   + |TPOR| for  2>PER/TPOR 3>PO*RPLS',
+        '2020-02-02 12:00:00.000     |HEL|        >H-L', # backfilled
+        '2020-02-02 12:00:04.000   + |PER| per',
+        '',
+    ]
+
+    def test_analysis(self):
+        analysis = plover_tapey_tape.analyze_chunk((self.lines, 0, self.settings))
+        self.assertEqual(analysis['lines'], 8)
+        self.assertEqual(analysis['suggestions'], {'KW*EFP': 1, 'PER/TPOR': 1, 'PO*RPLS': 1, 'H-L': 1})
+        self.assertEqual(analysis['hesitation']['PER'], (1.25, 2))
+        self.assertEqual(analysis['fingerspelled'], {'kve': 1})
+        self.assertEqual(analysis['hesitation']['HEL'], (0.25, 1))
+        self.assertEqual(analysis['hesitation']['*E'], (1.0, 1))
+
+    def test_context(self):
+        analysis = plover_tapey_tape.analyze_chunk((self.lines, 3, self.settings))
+        self.assertEqual(analysis['lines'], 5)
+        self.assertEqual(analysis['fingerspelled'], {'kve': 1})
+        self.assertNotIn('SR*', analysis['hesitation'])
+
+class TestTapeFile(unittest.TestCase):
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'tape.txt'
+            file = plover_tapey_tape.TapeFile(path, max_size=100, max_archives=3)
+            text = ''
+            for i in range(50):
+                # Every fifth line is delayed as if by fingerspelling
+                chunks = [f'line {i} ', 'delayed\n'] if i % 5 == 0 else [f'line {i}\n']
+                for chunk in chunks:
+                    file.write(chunk)
+                    text += chunk
+            file.close()
+            archives = sorted(path.parent.glob('tape.txt.*.gz'))
+            self.assertEqual(len(archives), 3)
+            segments = [gzip.decompress(archive.read_bytes()).decode('utf-8') for archive in archives]
+            segments.append(path.read_text(encoding='utf-8'))
+            for segment in segments:
+                self.assertTrue(segment.endswith('\n'))
+            self.assertTrue(text.endswith(''.join(segments)))
+
+    def test_archives(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'tape.txt'
+            names = ['tape.txt.20240131-093000-000000-2.gz', 'tape.txt.20240131-093000-000000.gz',
+                     'tape.txt.20240130-120000-000000.gz', 'tape.txt.audit.20240101-000000-000000.gz',
+                     'tape.txt.20240131-093000-000000']
+            for name in names:
+                (path.parent / name).touch()
+            self.assertEqual([archive.name for archive in plover_tapey_tape.tape_archives(path)],
+                             [names[2], names[1], names[0]])
+
+class TestPublisher(unittest.TestCase):
+    def receive(self, sock, size):
+        data = b''
+        while len(data) < size:
+            data += sock.recv(size - len(data))
+        return data
+
+    def test_replay_and_stream(self):
+        publisher = plover_tapey_tape.Publisher(None, 0, 10, 2)
+        try:
+            publisher.write('one\ntwo\nthree\nfour ')
+            with socket.create_connection(publisher.address, timeout=5) as viewer:
+                self.assertEqual(self.receive(viewer, 10), b'two\nthree\n')
+                publisher.write('delayed\n')
+                self.assertEqual(self.receive(viewer, 13), b'four delayed\n')
+        finally:
+            publisher.close()
+
+    def test_drop_oldest(self):
+        client = plover_tapey_tape.PublisherClient(None, [b'1\n', b'2\n'], 3)
+        client.extend([b'3\n', b'4\n', b'5\n'])
+        self.assertEqual(list(client.lines), [b'3\n', b'4\n', b'5\n'])
+        self.assertEqual(client.dropped, 2)
+
+class TestTimeIndex(unittest.TestCase):
+    def test_live_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'tape.txt'
+            index = plover_tapey_tape.TimeIndex(path, 0.0, 2, None)
+            file = plover_tapey_tape.TapeFile(path, time_index=index)
+            for i in range(5):
+                file.write(f'line {i}\n')
+            file.close()
+            entries = plover_tapey_tape.read_time_index(path.with_name('tape.txt.idx'))
+            self.assertEqual([offset for _, offset in entries], [0, 14, 28])
+
+    def test_read_time_range(self):
+        pattern = plover_tapey_tape.line_pattern('%t %D', '>', 5)
+        lines = [f'2024-01-31 14:{minute:02}:00.000 word{minute}\n' for minute in range(60)]
+        with tempfile.TemporaryDirectory() as directory:
+            archive = pathlib.Path(directory) / 'tape.txt.20240131-150000-000000.gz'
+            archive.write_bytes(gzip.compress(''.join(lines[:30]).encode('utf-8')))
+            path = pathlib.Path(directory) / 'tape.txt'
+            path.write_text(''.join(lines[30:]), encoding='utf-8')
+            segments = plover_tapey_tape.tape_segments(path)
+            self.assertEqual(segments, [archive, path])
+            start = plover_tapey_tape.datetime.datetime(2024, 1, 31, 14, 5)
+            end = plover_tapey_tape.datetime.datetime(2024, 1, 31, 14, 35)
+            for _ in range(2): # without and with the saved index
+                self.assertEqual(list(plover_tapey_tape.read_time_range(segments, start, end, pattern)),
+                                 lines[5:36])
+            self.assertEqual(len(plover_tapey_tape.read_time_index(archive.with_name(archive.name[:-3] + '.idx'))),
+                             30)
+            self.assertFalse(path.with_name('tape.txt.idx').exists())
+
 if __name__ == '__main__':
     unittest.main()